@@ -0,0 +1,704 @@
+""" Benchmarks of the ingestion stages.
+
+Usage:
+    python benchmark.py cpu [FIXTURES]
+    python benchmark.py record FIXTURES --node URL --start BLOCK [--blocks N]
+    python benchmark.py run FIXTURES [--mongo HOST:PORT] [--latency SECONDS]
+        [--error-rate RATE] [--baseline FILE] [--save-baseline FILE]
+
+`cpu` benchmarks the normalizer and `parse_operations` per op type, on the
+operations of a fixture file, or on built-in samples.
+
+`record` runs every stage against a live node through a recording proxy,
+and saves all the JSON-RPC responses into a gzipped fixture file.
+
+`run` replays a fixture file from a local fake steemd, with optional latency
+and error injection, and runs every stage against a throwaway database
+(a temporary mongod, unless `--mongo` is given). It reports ops/sec, RPCs per op,
+Mongo writes per op and peak RSS per stage. With `--baseline`, it exits
+with status 1 if a stage regressed by more than `--tolerance`.
+"""
+import argparse
+import gzip
+import json
+import multiprocessing
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pymongo
+from funcy import compose, first, flatten, keep, merge_with
+from pymongo import monitoring
+from steem.blockchain import Blockchain
+from steem.utils import keep_in_dict, parse_time
+from steemdata.utils import json_expand, remove_body, typify
+
+from clients import get_steemd, node_pool
+from methods import parse_operations
+from mongostorage import MongoStorage
+from scraper import (
+    ChainVerifier,
+    insert_blocks,
+    insert_operations,
+    post_processing,
+    scrape_comments,
+)
+from utils import normalize_operation, stop_at_end, strip_dot_from_keys
+
+BENCHMARK_DB = 'SteemDataBenchmark'
+
+sample_operations = [
+    {
+        'type': 'comment', 'block_num': 20000001, 'trx_id': 'a1b2', 'op_in_trx': 0,
+        'timestamp': '2018-02-18T12:00:00', 'parent_author': '', 'parent_permlink': 'steem',
+        'author': 'alice', 'permlink': 'hello-world', 'title': 'Hello World',
+        'body': 'Lorem ipsum dolor sit amet. ' * 100,
+        'json_metadata': '{"tags":["steem","introduceyourself"],"app":"steemit/0.1"}',
+    },
+    {
+        'type': 'vote', 'block_num': 20000001, 'trx_id': 'c3d4', 'op_in_trx': 0,
+        'timestamp': '2018-02-18T12:00:00', 'voter': 'bob', 'author': 'alice',
+        'permlink': 'hello-world', 'weight': 10000,
+    },
+    {
+        'type': 'transfer', 'block_num': 20000002, 'trx_id': 'e5f6', 'op_in_trx': 0,
+        'timestamp': '2018-02-18T12:00:03', 'from': 'bob', 'to': 'alice',
+        'amount': '1.000 STEEM', 'memo': 'thanks!',
+    },
+    {
+        'type': 'custom_json', 'block_num': 20000002, 'trx_id': 'a7b8', 'op_in_trx': 0,
+        'timestamp': '2018-02-18T12:00:03', 'id': 'follow',
+        'required_auths': [], 'required_posting_auths': ['bob'],
+        'json': '["follow",{"follower":"bob","following":"alice","what":["blog"]}]',
+    },
+    {
+        'type': 'account_update', 'block_num': 20000003, 'trx_id': 'c9d0', 'op_in_trx': 0,
+        'timestamp': '2018-02-18T12:00:06', 'account': 'alice',
+        'memo_key': 'STM6FATHLohxTN8RWWkU9ZZwVywXo6MEDjHHui1jEBYkG2tTdvMYo',
+        'json_metadata': '{"profile":{"name":"Alice","website":"alice.example.com"}}',
+    },
+    {
+        'type': 'curation_reward', 'block_num': 20000003, 'trx_id': '0000', 'op_in_trx': 1,
+        'timestamp': '2018-02-18T12:00:06', 'curator': 'bob',
+        'reward': '12.345678 VESTS', 'comment_author': 'alice', 'comment_permlink': 'hello-world',
+    },
+    {
+        'type': 'producer_reward', 'block_num': 20000003, 'trx_id': '0000', 'op_in_trx': 2,
+        'timestamp': '2018-02-18T12:00:06', 'producer': 'carol',
+        'vesting_shares': '391.025350 VESTS',
+    },
+    {
+        'type': 'custom_json', 'block_num': 20000004, 'trx_id': 'e1f2', 'op_in_trx': 0,
+        'timestamp': '2018-02-18T12:00:09', 'id': 'app.example',
+        'required_auths': [], 'required_posting_auths': ['carol'],
+        'json': '{"items":[{"file.name":"a.png","size.kb":12}],"v.1":true}',
+    },
+]
+
+
+# Fixtures
+# --------
+def rpc_key(method, params):
+    """ Identify a JSON-RPC call, regardless of the api it was sent to. """
+    if method == 'call':
+        _, method, params = params
+    return json.dumps([method.split('.')[-1], params], sort_keys=True)
+
+
+class Fixtures(object):
+    """ Recorded JSON-RPC responses of a block range. """
+
+    def __init__(self, start_block, end_block, responses=None):
+        self.start_block = start_block
+        self.end_block = end_block
+        self.responses = responses or {}
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt') as f:
+            meta = json.loads(f.readline())
+            responses = {}
+            for line in f:
+                item = json.loads(line)
+                responses[rpc_key(item['method'], item['params'])] = item['result']
+        return cls(meta['start_block'], meta['end_block'], responses)
+
+    def save(self, path):
+        with gzip.open(path, 'wt') as f:
+            f.write(json.dumps({
+                'start_block': self.start_block,
+                'end_block': self.end_block,
+            }) + '\n')
+            for key, result in sorted(self.responses.items()):
+                method, params = json.loads(key)
+                f.write(json.dumps({
+                    'method': method, 'params': params, 'result': result}) + '\n')
+
+    def operations(self):
+        """ The operations of the range, as yielded by `Blockchain.history()`. """
+        for block_num in range(self.start_block, self.end_block + 1):
+            events = self.responses.get(rpc_key('get_ops_in_block', [block_num, False]), [])
+            for event in events:
+                op_type, op = event['op']
+                yield {
+                    **op,
+                    '_id': Blockchain.hash_op(event),
+                    'type': op_type,
+                    'timestamp': parse_time(event.get('timestamp')),
+                    'block_num': event.get('block'),
+                    'trx_id': event.get('trx_id'),
+                }
+
+
+# Fake steemd
+# -----------
+class FakeSteemd(ThreadingMixIn, HTTPServer):
+    """ A JSON-RPC server that replays fixtures.
+
+    With an `upstream` node, calls are forwarded to it and recorded instead.
+    The head of the chain is always reported right after the fixture range.
+
+    Args:
+        fixtures: Fixtures to replay, or record into.
+        upstream: Node url to record from.
+        latency: Seconds to delay every HTTP request with.
+        error_rate: Share of HTTP requests that fail with a 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, fixtures, upstream=None, latency=0, error_rate=0):
+        super(FakeSteemd, self).__init__(('127.0.0.1', 0), FakeSteemdHandler)
+        self.fixtures = fixtures
+        self.upstream = upstream
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = Counter()
+            self.requests = 0
+            self.errors = 0
+
+    def handle_request_body(self, payload):
+        """ Returns a (status, response) tuple. """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return 503, None
+
+        if isinstance(payload, list):
+            return 200, [self.handle_call(x) for x in payload]
+        return 200, self.handle_call(payload)
+
+    def handle_call(self, call):
+        key = rpc_key(call['method'], call.get('params', []))
+        method, _ = json.loads(key)
+        with self._lock:
+            self.calls[method] += 1
+
+        result = self.fixtures.responses.get(key)
+        if result is None and self.upstream:
+            result = self.forward(call)
+            self.fixtures.responses[key] = result
+        if result is None:
+            return {'jsonrpc': '2.0', 'id': call.get('id'), 'error': {
+                'code': -32000, 'message': 'Not in fixtures: %s' % key}}
+
+        if method == 'get_dynamic_global_properties':
+            # one block past the range, so bounded block streams stop
+            result = {
+                **result,
+                'head_block_number': self.fixtures.end_block + 1,
+                'last_irreversible_block_num': self.fixtures.end_block + 1,
+            }
+        return {'jsonrpc': '2.0', 'id': call.get('id'), 'result': result}
+
+    def forward(self, call):
+        request = urllib.request.Request(
+            self.upstream,
+            data=json.dumps({**call, 'id': 1}).encode(),
+            headers={'Content-Type': 'application/json'},
+        )
+        with urllib.request.urlopen(request, timeout=30) as r:
+            return json.loads(r.read().decode()).get('result')
+
+
+class FakeSteemdHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, response = self.server.handle_request_body(json.loads(body.decode()))
+        data = json.dumps(response).encode() if response is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+# Stages
+# ------
+class WriteCounter(monitoring.CommandListener):
+    """ Count the Mongo write commands of this process. """
+    commands = ('insert', 'update', 'delete', 'findAndModify')
+
+    def __init__(self):
+        self.writes = 0
+
+    def started(self, event):
+        if event.command_name in self.commands:
+            self.writes += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def stage_blocks(mongo, start_block, end_block):
+    steemd = get_steemd()
+    blocks = steemd.get_blocks(range(start_block, end_block + 1))
+    verifier = ChainVerifier(mongo)
+    verifier.recent[blocks[0]['previous']] = start_block - 1
+    insert_blocks(mongo, blocks, verifier=verifier)
+    return len(blocks)
+
+
+def stage_operations(mongo, start_block, end_block):
+    history = Blockchain(steemd_instance=get_steemd()).history(
+        start_block=start_block,
+        end_block=end_block,
+    )
+    insert_operations(mongo, stop_at_end(history), lambda _: None, start_block)
+    return range_count(mongo, start_block, end_block)
+
+
+def stage_comments(mongo, start_block, end_block):
+    mongo.indexer.set_checkpoint('comments', start_block - 1, force=True)
+    # the recorded Operations are complete
+    mongo.indexer.set_checkpoint('operations', end_block, force=True)
+    while scrape_comments(mongo) is not None:
+        pass
+    return range_count(mongo, start_block, end_block, type='comment')
+
+
+def stage_post_processing(mongo, start_block, end_block):
+    mongo.indexer.set_checkpoint('post_processing', start_block - 1, force=True)
+    # the recorded Operations are complete
+    mongo.indexer.set_checkpoint('operations', end_block, force=True)
+    while post_processing(mongo) is not None:
+        pass
+    return range_count(mongo, start_block, end_block)
+
+
+# in order, later stages read the Operations of earlier ones
+stages = {
+    'blocks': stage_blocks,
+    'operations': stage_operations,
+    'comments': stage_comments,
+    'post_processing': stage_post_processing,
+}
+
+
+def range_count(mongo, start_block, end_block, **query):
+    return mongo.Operations.count_documents(
+        {**query, 'block_num': {'$gte': start_block, '$lte': end_block}})
+
+
+def run_stage(stage, node, connection_args, start_block, end_block):
+    """ Run a stage in a fresh process, so peak RSS is per stage. """
+    counter = WriteCounter()
+    monitoring.register(counter)
+    node_pool.configure([node])
+    mongo = MongoStorage(**connection_args)
+
+    start = time.perf_counter()
+    ops = stages[stage](mongo, start_block, end_block)
+    mongo.indexer.flush()
+    mongo.ingestion.flush()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'ops': ops,
+        'seconds': elapsed,
+        'writes': counter.writes,
+        # kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_stages(server, connection_args, names=None):
+    client = pymongo.MongoClient(connection_args['host'], int(connection_args['port']))
+    client.drop_database(connection_args['db_name'])
+    MongoStorage(**connection_args).ensure_indexes()
+
+    results = {}
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        for stage in names or stages:
+            server.reset_counters()
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run_stage, (
+                    stage, server.url, connection_args,
+                    server.fixtures.start_block, server.fixtures.end_block))
+            ops = max(r['ops'], 1)
+            results[stage] = {
+                'ops': r['ops'],
+                'ops_per_sec': r['ops'] / r['seconds'],
+                'rpcs_per_op': sum(server.calls.values()) / ops,
+                'writes_per_op': r['writes'] / ops,
+                'peak_rss_mb': r['peak_rss_mb'],
+                'rpc_errors': server.errors,
+            }
+    finally:
+        client.drop_database(connection_args['db_name'])
+    return results
+
+
+@contextmanager
+def throwaway_mongod(port=27099):
+    """ Run a temporary mongod. Yields its connection args. """
+    dbpath = tempfile.mkdtemp(prefix='steemdata-benchmark-')
+    process = subprocess.Popen(
+        ['mongod', '--dbpath', dbpath, '--port', str(port), '--bind_ip', '127.0.0.1'],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        client = pymongo.MongoClient('127.0.0.1', port, serverSelectionTimeoutMS=30000)
+        client.admin.command('ping')
+        yield dict(db_name=BENCHMARK_DB, host='127.0.0.1', port=port)
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(dbpath, ignore_errors=True)
+
+
+@contextmanager
+def benchmark_mongo(address=None):
+    if not address:
+        with throwaway_mongod() as connection_args:
+            yield connection_args
+        return
+    host, _, port = address.partition(':')
+    yield dict(db_name=BENCHMARK_DB, host=host, port=int(port or 27017))
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ List the regressions of `results` against a `baseline`.
+
+    Throughput may not drop, and RPCs or writes per op may not grow,
+    by more than `tolerance`.
+    """
+    regressions = []
+    for stage, base in baseline.items():
+        r = results.get(stage)
+        if not r:
+            continue
+        if r['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.1f ops/sec (baseline %.1f)' % (
+                stage, r['ops_per_sec'], base['ops_per_sec']))
+        for key in ['rpcs_per_op', 'writes_per_op']:
+            if r[key] > base[key] * (1 + tolerance):
+                regressions.append('%s: %.3f %s (baseline %.3f)' % (
+                    stage, r[key], key, base[key]))
+    return regressions
+
+
+# CPU
+# ---
+def bench(fn, operations, min_time=1):
+    """ Run `fn` over `operations` for at least `min_time` seconds. Returns ops/sec. """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for op in operations:
+            fn(op)
+        count += len(operations)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def bench_normalizer(operations):
+    """ Compare `normalize_operation` with the composed steemdata pipeline. """
+    composed = compose(strip_dot_from_keys, remove_body, json_expand, typify)
+
+    def fused(op):
+        return normalize_operation(op, remove_body=True)
+
+    for op in operations:
+        assert composed(op) == fused(op), 'Results differ on %s' % op
+
+    composed_rate = bench(composed, operations)
+    fused_rate = bench(fused, operations)
+    return {
+        'composed': composed_rate,
+        'fused': fused_rate,
+        'speedup': fused_rate / composed_rate,
+    }
+
+
+def legacy_parse_operation(op):
+    """ `parse_operation` as an if/elif chain, before `operation_handlers`.
+
+    Kept as is (including the `convert` branch that never matched), as a baseline.
+    """
+    op_type = op['type']
+
+    update_accounts_light = set()
+    update_accounts_full = set()
+    update_comments = set()
+
+    def construct_identifier():
+        return '@%s/%s' % (
+            op.get('author', op.get('comment_author')),
+            op.get('permlink', op.get('comment_permlink')),
+        )
+
+    def account_from_auths():
+        return first(op.get('required_auths', op.get('required_posting_auths')))
+
+    if op_type in ['account_create',
+                   'account_create_with_delegation']:
+        update_accounts_light.add(op['creator'])
+        update_accounts_full.add(op['new_account_name'])
+
+    elif op_type in ['account_update',
+                     'withdraw_vesting',
+                     'claim_reward_balance',
+                     'return_vesting_delegation',
+                     'account_witness_vote']:
+        update_accounts_light.add(op['account'])
+
+    elif op_type == 'account_witness_proxy':
+        update_accounts_light.add(op['account'])
+        update_accounts_light.add(op['proxy'])
+
+    elif op_type in ['author_reward', 'comment']:
+        update_accounts_light.add(op['author'])
+        update_comments.add(construct_identifier())
+
+    elif op_type == 'vote':
+        update_accounts_light.add(op['voter'])
+        update_comments.add(construct_identifier())
+
+    elif op_type == 'cancel_transfer_from_savings':
+        update_accounts_light.add(op['from'])
+
+    elif op_type == 'change_recovery_account':
+        update_accounts_light.add(op['account_to_recover'])
+
+    elif op_type == 'comment_benefactor_reward':
+        update_accounts_light.add(op['benefactor'])
+
+    elif op_type == ['convert',
+                     'fill_convert_request',
+                     'interest',
+                     'limit_order_cancel',
+                     'limit_order_create',
+                     'shutdown_witness',
+                     'witness_update']:
+        update_accounts_light.add(op['owner'])
+
+    elif op_type == 'curation_reward':
+        update_accounts_light.add(op['curator'])
+
+    elif op_type in ['custom', 'custom_json']:
+        update_accounts_light.add(account_from_auths())
+
+    elif op_type == 'delegate_vesting_shares':
+        update_accounts_light.add(op['delegator'])
+        update_accounts_light.add(op['delegatee'])
+
+    elif op_type == 'delete_comment':
+        update_accounts_light.add(op['author'])
+
+    elif op_type in ['escrow_approve',
+                     'escrow_dispute',
+                     'escrow_release',
+                     'escrow_transfer']:
+        accs = keep_in_dict(op, ['agent', 'from', 'to', 'who', 'receiver']).values()
+        update_accounts_light.update(accs)
+
+    elif op_type == 'feed_publish':
+        update_accounts_light.add(op['publisher'])
+
+    elif op_type in ['fill_order']:
+        update_accounts_light.add(op['open_owner'])
+        update_accounts_light.add(op['current_owner'])
+
+    elif op_type in ['fill_vesting_withdraw']:
+        update_accounts_light.add(op['to_account'])
+        update_accounts_light.add(op['from_account'])
+
+    elif op_type == 'pow2':
+        acc = op['work'][1]['input']['worker_account']
+        update_accounts_light.add(acc)
+
+    elif op_type in ['recover_account',
+                     'request_account_recovery']:
+        update_accounts_light.add(op['account_to_recover'])
+
+    elif op_type == 'set_withdraw_vesting_route':
+        update_accounts_light.add(op['from_account'])
+        update_accounts_light.add(op['to_account'])
+    elif op_type in ['transfer',
+                     'transfer_from_savings',
+                     'transfer_to_savings',
+                     'transfer_to_vesting']:
+        accs = keep_in_dict(op, ['agent', 'from', 'to', 'who', 'receiver']).values()
+        update_accounts_light.update(accs)
+
+    return {
+        'accounts': list(update_accounts_full),
+        'accounts_light': list(update_accounts_light),
+        'comments': list(update_comments),
+    }
+
+
+def legacy_parse_operations(ops):
+    """ How post_processing merged the `legacy_parse_operation` results. """
+    def custom_merge(*args):
+        return list(set(keep(flatten(args))))
+
+    return merge_with(custom_merge, *map(legacy_parse_operation, ops))
+
+
+def bench_parse_operations(operations, batch_size=100, min_time=0.2):
+    """ Compare `parse_operations` with the if/elif chain.
+
+    Returns ops/sec by op type, and for all the ops mixed, in batches of `batch_size`.
+    """
+    by_type = defaultdict(list)
+    for op in operations:
+        by_type[op['type']].append(normalize_operation(op))
+    by_type['all'] = [x for ops in by_type.values() for x in ops]
+
+    results = {}
+    for op_type, ops in sorted(by_type.items()):
+        batch = (ops * (batch_size // len(ops) + 1))[:batch_size]
+        chain_rate = bench(legacy_parse_operations, [batch], min_time=min_time) * batch_size
+        table_rate = bench(parse_operations, [batch], min_time=min_time) * batch_size
+        results[op_type] = {
+            'chain': chain_rate,
+            'table': table_rate,
+            'speedup': table_rate / chain_rate,
+        }
+    return results
+
+
+# CLI
+# ---
+def print_table(title, rows):
+    print(title)
+    for k, v in rows.items():
+        if isinstance(v, dict):
+            print('  %-16s %s' % (k, '  '.join('%s=%.3f' % x for x in v.items())))
+        else:
+            print('  %-16s %12.1f' % (k, v))
+
+
+def cpu(args):
+    operations = sample_operations
+    if args.fixtures:
+        operations = list(Fixtures.load(args.fixtures).operations())
+    print_table('normalizer (%d operations):' % len(operations),
+                bench_normalizer(operations))
+    print_table('parse_operations (ops/sec):', bench_parse_operations(operations))
+
+
+def record(args):
+    fixtures = Fixtures(args.start, args.start + args.blocks - 1)
+    server = FakeSteemd(fixtures, upstream=args.node).start()
+    with benchmark_mongo(args.mongo) as connection_args:
+        run_stages(server, connection_args)
+    fixtures.save(args.fixtures)
+    print('Recorded %d responses into %s' % (len(fixtures.responses), args.fixtures))
+
+
+def run(args):
+    server = FakeSteemd(
+        Fixtures.load(args.fixtures),
+        latency=args.latency,
+        error_rate=args.error_rate,
+    ).start()
+    with benchmark_mongo(args.mongo) as connection_args:
+        results = run_stages(server, connection_args, names=args.stages)
+    print_table('stages:', results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), tolerance=args.tolerance)
+        for x in regressions:
+            print('REGRESSION %s' % x)
+        if regressions:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='steemdata-mongo benchmarks')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('cpu')
+    p.add_argument('fixtures', nargs='?')
+    p.set_defaults(fn=cpu)
+
+    p = commands.add_parser('record')
+    p.add_argument('fixtures')
+    p.add_argument('--node', required=True)
+    p.add_argument('--start', type=int, required=True)
+    p.add_argument('--blocks', type=int, default=100)
+    p.add_argument('--mongo', help='HOST:PORT, instead of a temporary mongod')
+    p.set_defaults(fn=record)
+
+    p = commands.add_parser('run')
+    p.add_argument('fixtures')
+    p.add_argument('--mongo', help='HOST:PORT, instead of a temporary mongod')
+    p.add_argument('--stages', nargs='+', choices=list(stages))
+    p.add_argument('--latency', type=float, default=0)
+    p.add_argument('--error-rate', type=float, default=0)
+    p.add_argument('--baseline')
+    p.add_argument('--save-baseline')
+    p.add_argument('--tolerance', type=float, default=0.2)
+    p.set_defaults(fn=run)
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        sys.exit(2)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+
+from steem.steemd import Steemd
+
+from metrics import Buckets, registry
+
+# comma separated list of steemd nodes
+STEEMD_NODES = os.getenv('STEEMD_NODES', 'https://api.steemit.com').split(',')
+# always use this node first, regardless of its health score
+STEEMD_NODE = os.getenv('STEEMD_NODE')
+
+
+class NodePool(object):
+    """ Score steemd nodes by health, and hand out a shared client.
+
+    Every call made through the shared client is timed. Node scores are an
+    exponentially weighted average of call latency, where failed calls count
+    as `error_penalty` seconds, so slow and failing nodes get demoted.
+    The client fails over to the next best node on errors.
+
+    The nodes are probed from a background thread, so getting the client
+    never waits on the network.
+
+    Args:
+        nodes: A list of steemd node urls.
+        pinned: A node that is always used first.
+        probe_interval: Seconds between health probes of all the nodes.
+        error_penalty: Latency (in seconds) a failed call is scored as.
+        switch_ratio: The best node is only replaced by one that scores
+        better than `switch_ratio` times its score, so that nodes with
+        a similar latency don't take turns.
+        client_kwargs: Connection pool options for the steemd client.
+    """
+
+    def __init__(self, nodes, pinned=None, probe_interval=60, error_penalty=10,
+                 switch_ratio=0.7, **client_kwargs):
+        self.probe_interval = probe_interval
+        self.error_penalty = error_penalty
+        self.switch_ratio = switch_ratio
+        self._lock = threading.RLock()
+        self._prober = None
+        self.configure(nodes, pinned, **client_kwargs)
+
+    def configure(self, nodes, pinned=None, **client_kwargs):
+        """ Replace the nodes of the pool, ie. to point a process at a test node. """
+        with self._lock:
+            self.nodes = list(nodes)
+            if pinned and pinned not in self.nodes:
+                self.nodes.insert(0, pinned)
+            self.pinned = pinned
+            self.client_kwargs = {
+                'maxsize': 50,
+                'num_pools': len(self.nodes),
+                'tcp_keepalive': True,
+                **client_kwargs,
+            }
+
+            self.scores = {x: 0.0 for x in self.nodes}
+            self.errors = {x: 0 for x in self.nodes}
+            self.latency = {x: Buckets() for x in self.nodes}
+            self._best = None
+            self._client = None
+            self._probe_clients = {}
+
+    def observe(self, node, latency, error=False):
+        """ Record a call to `node`. """
+        with self._lock:
+            if node not in self.scores:
+                return
+            self.latency[node].observe(latency)
+            if error:
+                self.errors[node] += 1
+                latency = max(latency, self.error_penalty)
+            self.scores[node] = 0.8 * self.scores[node] + 0.2 * latency
+
+    def ranked(self):
+        """ Nodes from best to worst. """
+        with self._lock:
+            ranked = sorted(self.nodes, key=lambda x: self.scores[x])
+        if self.pinned:
+            ranked.remove(self.pinned)
+            ranked.insert(0, self.pinned)
+        return ranked
+
+    def best(self):
+        """ The node to send calls to. """
+        with self._lock:
+            ranked = self.ranked()
+            current = self._best
+            if (current not in self.scores or self.pinned
+                    or self.scores[ranked[0]] < self.scores[current] * self.switch_ratio):
+                self._best = ranked[0]
+            return self._best
+
+    def probe(self):
+        """ Time a cheap call on every node. """
+        with self._lock:
+            nodes = list(self.nodes)
+            clients = self._probe_clients
+            for node in nodes:
+                if node not in clients:
+                    clients[node] = PooledSteemd(self, nodes=[node], **{
+                        **self.client_kwargs, 'retries': 0, 'timeout': 5})
+        for node in nodes:
+            try:
+                clients[node].get_dynamic_global_properties()
+            except Exception:
+                pass
+
+    def _probe_forever(self):
+        while True:
+            if len(self.nodes) > 1:
+                self.probe()
+            time.sleep(self.probe_interval)
+
+    def client(self) -> Steemd:
+        """ The shared client, pointed at the best node. """
+        with self._lock:
+            if not self._prober:
+                self._prober = threading.Thread(
+                    target=self._probe_forever, name='steemd-probe', daemon=True)
+                self._prober.start()
+            if not self._client:
+                self._client = PooledSteemd(self, nodes=self.ranked(), **self.client_kwargs)
+            client = self._client
+            best = self.best()
+        # the connection pools of every node are kept alive
+        if client.url != best:
+            client.set_node(best)
+        return client
+
+    def stats(self):
+        with self._lock:
+            return {
+                node: {
+                    'score': self.scores[node],
+                    'errors': self.errors[node],
+                    'latency': self.latency[node].export(),
+                }
+                for node in self.nodes
+            }
+
+
+class PooledSteemd(Steemd):
+    """ A steemd client that reports the latency of its calls to a NodePool. """
+
+    def __init__(self, node_pool, nodes, **kwargs):
+        self.node_pool = node_pool
+        super(PooledSteemd, self).__init__(nodes=nodes, **kwargs)
+
+    def exec(self, name, *args, **kwargs):
+        node = self.url
+        start = time.time()
+        try:
+            result = super(PooledSteemd, self).exec(name, *args, **kwargs)
+        except Exception:
+            self.node_pool.observe(node, time.time() - start, error=True)
+            rpc_errors.inc(method=name, node=node)
+            raise
+        self.node_pool.observe(node, time.time() - start)
+        rpc_latency.observe(time.time() - start, method=name, node=node)
+        rpc_calls.inc(method=name, node=node)
+        return result
+
+
+rpc_latency = registry.histogram(
+    'steemd_rpc_seconds', 'Latency of steemd calls', ['method', 'node'])
+rpc_errors = registry.counter(
+    'steemd_rpc_errors_total', 'Failed steemd calls', ['method', 'node'])
+# JSON-RPC batches hold many calls per request
+rpc_calls = registry.counter(
+    'steemd_rpc_calls_total', 'Successful steemd calls', ['method', 'node'])
+
+
+node_pool = NodePool(STEEMD_NODES, pinned=STEEMD_NODE)
+
+
+def get_steemd() -> Steemd:
+    """ Get the shared, pooled steemd client of this process. """
+    return node_pool.client()
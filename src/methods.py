@@ -1,17 +1,46 @@
 import datetime as dt
+import hashlib
+import json
+import logging
+import math
+import os
+from collections import namedtuple, defaultdict
 from contextlib import suppress
+from functools import partial
+from itertools import takewhile
 
 import pymongo
-from funcy import compose, take, first
-from pymongo.errors import DuplicateKeyError, WriteError
+from funcy import take, first, chunks, silent, get_in
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from steem.account import Account
+from steem.amount import Amount
 from steem.post import Post
 from steem.utils import keep_in_dict
 from steembase.exceptions import PostDoesNotExist
-from steemdata.utils import typify, json_expand, remove_body
+from steemdata.utils import typify
 from toolz import pipe
 
-from utils import strip_dot_from_keys, safe_json_metadata
+from clients import get_steemd
+from mongostorage import BufferedWriter, mongo_documents, mongo_write_latency, mongo_writes
+from rpc import fetch_comments
+from utils import normalize_operation, strip_dot_from_keys, safe_json_metadata, thread_multi
+
+log = logging.getLogger(__name__)
+
+# write errors caused by the document itself, most likely by its json_metadata
+INVALID_DOCUMENT_ERRORS = {
+    2,  # BadValue
+    52,  # DollarPrefixedFieldName
+    57,  # DottedFieldName
+    10334,  # BSONObjectTooLarge
+    17280,  # KeyTooLong
+}
+DUPLICATE_KEY_ERROR = 11000
+
+# derive AccountOperations from Operations (see `derive_account_operations`),
+# rather than fetching account history over RPC. The two modes are exclusive.
+derived_account_ops = os.getenv('DERIVED_ACCOUNT_OPS', '').lower() in ('1', 'true', 'yes')
 
 
 def upsert_comment_chain(mongo, identifier, recursive=False):
@@ -22,18 +51,109 @@ def upsert_comment_chain(mongo, identifier, recursive=False):
         identifier: Post identifier
         recursive: (Defaults to False). Recursively update all parent comments.
     """
-    with suppress(PostDoesNotExist):
-        p = Post(identifier)
-        upsert_comment(mongo, p.identifier)
-        if recursive and p.is_comment():
-            parent_identifier = '@%s/%s' % (p.parent_author, p.parent_permlink)
-            upsert_comment_chain(mongo, parent_identifier, recursive)
+    if recursive:
+        return upsert_comment_chains(mongo, [identifier])
+    return upsert_comment(mongo, identifier)
+
+
+def upsert_comment_chains(mongo, identifiers):
+    """ Upsert many comments, and all of their parents.
+
+    The ancestors are resolved level by level, so every unique identifier
+    is fetched only once, even if it is shared by many comments in a thread.
+    """
+    comments = {}
+    seen = set()
+    level = set(identifiers)
+    while level:
+        seen |= level
+        fetched = fetch_comments(level)
+        comments.update({x['identifier']: x for x in fetched})
+        level = {'@%s/%s' % (x['parent_author'], x['parent_permlink'])
+                 for x in fetched if x['depth'] > 0} - seen
+
+    return upsert_comments(mongo, comments.values())
+
+
+def upsert_comments(mongo, comments):
+    """ Upsert exported comments with one bulk write per collection.
+
+    Returns the bulk write results by collection name.
+    """
+    now = dt.datetime.utcnow()
+    comments = list(comments)
+    results = {}
+    for collection, items in [
+        ('Posts', [x for x in comments if x['depth'] == 0]),
+        ('Comments', [x for x in comments if x['depth'] > 0]),
+    ]:
+        if items:
+            results[collection] = bulk_write_safe(
+                mongo.db[collection],
+                items,
+                lambda x: UpdateOne({'identifier': x['identifier']},
+                                    {'$set': {**x, 'updatedAt': now}},
+                                    upsert=True),
+            )
+            mongo.ingestion.record(collection, results[collection])
+    return results
+
+
+def bulk_write_safe(collection, documents, to_request):
+    """ Write documents with a single unordered bulk write.
+
+    Documents that are rejected as invalid (likely because of their
+    json_metadata) are retried once, with their json_metadata blanked.
+    Duplicate key errors are skipped, any other error is raised.
+
+    Args:
+        collection: pymongo collection
+        documents: A list of documents.
+        to_request: A function that turns a document into a write request.
+
+    Returns:
+        A dict with the (combined) bulk write result counts.
+    """
+    with mongo_write_latency.time(collection=collection.name):
+        result = _bulk_write_safe(collection, documents, to_request)
+    mongo_writes.inc(collection=collection.name)
+    mongo_documents.inc(
+        sum(result.get(k, 0) for k in ['nInserted', 'nUpserted', 'nModified']),
+        collection=collection.name)
+    return result
+
+
+def _bulk_write_safe(collection, documents, to_request):
+    counts = ['nInserted', 'nUpserted', 'nMatched', 'nModified', 'nRemoved']
+    try:
+        return collection.bulk_write(
+            [to_request(x) for x in documents], ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+        errors = result.get('writeErrors', [])
+        if not errors or any(x['code'] not in INVALID_DOCUMENT_ERRORS | {DUPLICATE_KEY_ERROR}
+                             for x in errors):
+            raise
+
+    failed = [documents[x['index']] for x in errors
+              if x['code'] in INVALID_DOCUMENT_ERRORS]
+    if not failed:
+        return {k: result.get(k, 0) for k in counts}
+
+    for document in failed:
+        log.warning("Invalidated json_metadata on %s" %
+                    document.get('identifier', document.get('name')))
+    retry = collection.bulk_write(
+        [to_request({**x, 'json_metadata': {}}) for x in failed],
+        ordered=False).bulk_api_result
+
+    return {k: result.get(k, 0) + retry.get(k, 0) for k in counts}
 
 
 def get_comment(identifier):
     with suppress(PostDoesNotExist):
         return pipe(
-            Post(identifier).export(),
+            Post(identifier, steemd_instance=get_steemd()).export(),
             strip_dot_from_keys,
             safe_json_metadata
         )
@@ -41,14 +161,9 @@ def get_comment(identifier):
 
 def upsert_comment(mongo, identifier):
     """ Upsert root post or comment. """
-    with suppress(PostDoesNotExist, DuplicateKeyError):
-        c = get_comment(identifier)
-        update = {'$set': {**c, 'updatedAt': dt.datetime.utcnow()}}
-        if c['depth'] > 0:
-            return mongo.Comments.update(
-                {'identifier': c['identifier']},
-                update, upsert=True)
-        return mongo.Posts.update({'identifier': c['identifier']}, update, upsert=True)
+    comment = get_comment(identifier)
+    if comment:
+        return upsert_comments(mongo, [comment])
 
 
 def update_account(mongo, username, load_extras=True):
@@ -60,32 +175,316 @@ def update_account(mongo, username, load_extras=True):
      - withdrawal routers, conversion requests
 
     """
-    a = Account(username)
+    return update_accounts(mongo, [username], load_extras=load_extras)
+
+
+def update_accounts(mongo, usernames, load_extras=True, max_workers=50):
+    """ Fetch many accounts in batches, and write them in a single bulk write. """
+    accounts = fetch_accounts(usernames)
+    if load_extras:
+        extras = fetch_account_extras(
+            dict.fromkeys(accounts, list(account_extras_loaders)),
+            max_workers=max_workers,
+        )
+        for name, loaded in extras.items():
+            accounts[name].update(loaded)
+
+    now = dt.datetime.utcnow()
+    accounts = [{**x, 'updatedAt': now} for x in accounts.values()]
+    return write_accounts(mongo, accounts, load_extras)
+
+
+def write_accounts(mongo, accounts, load_extras=True):
+    """ Upsert exported accounts.
+
+    Accounts exported with extras replace the whole document,
+    otherwise only the exported fields are updated.
+    """
+    def to_request(account):
+        if load_extras:
+            return ReplaceOne({'name': account['name']}, account, upsert=True)
+        return UpdateOne({'name': account['name']}, {'$set': account}, upsert=True)
+
+    if accounts:
+        result = bulk_write_safe(mongo.Accounts, accounts, to_request)
+        mongo.ingestion.record('Accounts', result)
+        return result
+
+
+# Account refresh tiers
+# ---------------------
+# Light refreshes are served from batched `get_accounts` calls. Extras need
+# their own RPC calls, so they are only loaded when an op can affect them.
+def _load_followers(a):
+    followers = a.get_followers()
+    following = a.get_following()
+    return {
+        'followers': followers,
+        'followers_count': len(followers),
+        'following': following,
+        'following_count': len(following),
+    }
+
+
+account_extras_loaders = {
+    'followers': _load_followers,
+    'curation_stats': lambda a: {'curation_stats': a.curation_stats()},
+    'withdrawal_routes': lambda a: {'withdrawal_routes': a.get_withdraw_routes()},
+    'conversion_requests': lambda a: {'conversion_requests': a.get_conversion_requests()},
+}
+
+accounts_batch_size = int(os.getenv('ACCOUNTS_BATCH_SIZE', 100))
+
+
+def refresh_accounts(mongo, accounts, max_workers=50):
+    """ Refresh accounts, and only `$set` the fields that have changed.
+
+    Args:
+        mongo: mongodb instance
+        accounts: A dict of account name -> names of the extras to load
+        (see `account_extras_loaders`). Base fields are always refreshed.
+        max_workers: Number of accounts to load extras for concurrently.
+    """
+    exported = fetch_accounts(accounts)
+    extras = fetch_account_extras(
+        {k: v for k, v in accounts.items() if k in exported},
+        max_workers=max_workers,
+    )
+    for name, loaded in extras.items():
+        exported[name].update(loaded)
+
+    # only the refreshed fields are compared, so only those are read
+    fields = set().union(*exported.values())
+    stored = mongo.Accounts.find(
+        {'name': {'$in': list(exported)}},
+        {'_id': 0, **dict.fromkeys(fields, 1)},
+    )
+    stored = {x['name']: x for x in stored}
+    changes = [
+        {**changed_fields(account, stored.get(name, {})), 'name': name}
+        for name, account in exported.items()
+    ]
+    changes = [x for x in changes if len(x) > 1]
+
+    now = dt.datetime.utcnow()
+    if changes:
+        result = bulk_write_safe(
+            mongo.Accounts,
+            changes,
+            lambda x: UpdateOne({'name': x['name']},
+                                {'$set': {**x, 'updatedAt': now}},
+                                upsert=True),
+        )
+        mongo.ingestion.record('Accounts', result)
+        return result
+
+
+def fetch_accounts(usernames, batch_size=None, steem=None):
+    """ Fetch and export many accounts with batched `get_accounts` calls.
+
+    Args:
+        usernames: An iterable of account names.
+        batch_size: Number of accounts per call. Defaults to ACCOUNTS_BATCH_SIZE.
+        steem: A steemd client to use.
+
+    Returns:
+        A dict of account name -> exported account.
+        Accounts that don't exist are left out.
+    """
+    usernames = list(usernames)
+    if not usernames:
+        return {}
+
+    steem = steem or get_steemd()
+    props = steem.get_dynamic_global_properties()
+    steem_per_mvests = Amount(props['total_vesting_fund_steem']).amount / \
+        (Amount(props['total_vesting_shares']).amount / 1e6)
+
+    exported = {}
+    for names in chunks(batch_size or accounts_batch_size, usernames):
+        for raw in steem.get_accounts(names):
+            exported[raw['name']] = export_account_light(raw, steem_per_mvests)
+    return exported
+
+
+def fetch_account_extras(accounts, max_workers=50):
+    """ Load extras for many accounts concurrently.
+
+    Args:
+        accounts: A dict of account name -> names of the extras to load.
+
+    Returns:
+        A dict of account name -> loaded fields.
+    """
+    return dict(thread_multi(
+        fn=_load_account_extras,
+        fn_args=[None, None],
+        dep_args=[[k, v] for k, v in accounts.items() if v],
+        max_workers=max_workers,
+        re_raise_errors=False,
+        pool='accounts',
+    ))
+
+
+def _load_account_extras(username, extras):
+    return username, load_account_extras(username, extras)
+
+
+def export_account_light(raw, steem_per_mvests):
+    """ Export a raw `get_accounts` result like `Account.export(load_extras=False)`. """
+    json_metadata = silent(json.loads)(raw.get('json_metadata')) or {}
+    vests = Amount(raw['vesting_shares']).amount
     account = {
-        **typify(a.export(load_extras=load_extras)),
-        'account': username,
-        'updatedAt': dt.datetime.utcnow(),
+        **typify({
+            **raw,
+            'json_metadata': json_metadata,
+            'profile': get_in(json_metadata, ['profile'], default={})
+            if isinstance(json_metadata, dict) else {},
+            'sp': round(vests * steem_per_mvests / 1e6, 3),
+            'rep': reputation_score(raw['reputation']),
+            'balances': account_balances(raw),
+        }),
+        'account': raw['name'],
     }
     if type(account['json_metadata']) is dict:
         account['json_metadata'] = \
             strip_dot_from_keys(account['json_metadata'])
-    if not load_extras:
-        account = {'$set': account}
-    try:
-        mongo.Accounts.update({'name': a.name}, account, upsert=True)
-    except WriteError:
-        # likely an invalid profile
-        account['json_metadata'] = {}
-        mongo.Accounts.update({'name': a.name}, account, upsert=True)
-        print("Invalidated json_metadata on %s" % a.name)
+    return account
 
 
-def update_account_ops(mongo, username):
-    """ This method will fetch entire account history, and back-fill any missing ops. """
-    for event in Account(username).history():
-        with suppress(DuplicateKeyError):
-            transform = compose(strip_dot_from_keys, remove_body, json_expand, typify)
-            mongo.AccountOperations.insert_one(transform(event))
+def load_account_extras(username, extras):
+    a = Account(username, steemd_instance=get_steemd())
+    loaded = {}
+    for extra in extras:
+        loaded.update(account_extras_loaders[extra](a))
+    return typify(loaded)
+
+
+def reputation_score(reputation, precision=2):
+    rep = int(reputation)
+    if rep == 0:
+        return 25
+    score = (math.log10(abs(rep)) - 9) * 9 + 25
+    if rep < 0:
+        score = 50 - score
+    return round(score, precision)
+
+
+def account_balances(raw):
+    def amount(field):
+        return Amount(raw[field]).amount
+
+    available = {
+        'STEEM': amount('balance'),
+        'SBD': amount('sbd_balance'),
+        'VESTS': amount('vesting_shares'),
+    }
+    savings = {
+        'STEEM': amount('savings_balance'),
+        'SBD': amount('savings_sbd_balance'),
+    }
+    rewards = {
+        'STEEM': amount('reward_steem_balance'),
+        'SBD': amount('reward_sbd_balance'),
+        'VESTS': amount('reward_vesting_balance'),
+    }
+    totals = {
+        'STEEM': available['STEEM'] + savings['STEEM'] + rewards['STEEM'],
+        'SBD': available['SBD'] + savings['SBD'] + rewards['SBD'],
+        'VESTS': available['VESTS'] + rewards['VESTS'],
+    }
+    return {
+        'available': available,
+        'savings': savings,
+        'rewards': rewards,
+        'total': {k: round(v, 3) for k, v in totals.items()},
+    }
+
+
+def changed_fields(document, stored):
+    """ Return the fields of `document` that differ from the `stored` one. """
+
+    def comparable(value):
+        # MongoDB returns naive datetimes
+        if isinstance(value, dt.datetime):
+            return value.replace(tzinfo=None)
+        if isinstance(value, dict):
+            return {k: comparable(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [comparable(x) for x in value]
+        return value
+
+    return {k: v for k, v in document.items()
+            if k not in stored or comparable(v) != comparable(stored[k])}
+
+
+def synced_account_ops(username):
+    """ Query the AccountOperations of `username` that were synced over RPC.
+
+    Derived AccountOperations have no `index`, so they are left out.
+    """
+    return {'account': username, 'index': {'$gte': 0}}
+
+
+def update_account_ops(mongo, username, batch_size=1000):
+    """ Sync missing account history.
+
+    Only the history past the highest stored index is fetched, along with
+    any interior gaps in the stored index range. The ops are bulk inserted.
+
+    Returns:
+        A dict with the number of `fetched`, `inserted` and `skipped`
+        (already stored, not re-fetched) ops.
+    """
+    transform = partial(normalize_operation, remove_body=True)
+    writer = BufferedWriter(mongo.AccountOperations, batch_size=batch_size,
+                            ingestion=mongo.ingestion)
+    account = Account(username, steemd_instance=get_steemd())
+
+    highest_index = account_operations_index(mongo, username)
+    stored = mongo.AccountOperations.count_documents(synced_account_ops(username))
+    ranges = account_operations_gaps(mongo, username, highest_index, stored)
+    ranges.append((highest_index, None))
+
+    fetched = inserted = 0
+    for start, stop in ranges:
+        history = account.history(start=start, batch_size=batch_size)
+        for event in takewhile(lambda x: stop is None or x['index'] <= stop, history):
+            writer.add(transform(event))
+            fetched += 1
+            if writer.is_due():
+                inserted += writer.flush()
+    inserted += writer.flush()
+
+    return {
+        'fetched': fetched,
+        'inserted': inserted,
+        'skipped': stored,
+    }
+
+
+def account_operations_gaps(mongo, username, highest_index, stored=None):
+    """ Find ranges of missing indexes below the highest synced index.
+
+    Returns a list of inclusive `(start, stop)` index ranges.
+    """
+    if stored is None:
+        stored = mongo.AccountOperations.count_documents(synced_account_ops(username))
+    if stored >= highest_index + 1:
+        return []
+
+    gaps = []
+    expected = 0
+    # use projection to ensure covered query
+    indexes = mongo.AccountOperations.find(
+        synced_account_ops(username), {'_id': 0, 'index': 1}).sort('index', pymongo.ASCENDING)
+    for item in indexes:
+        index = item.get('index', 0)
+        if index > expected:
+            gaps.append((expected, index - 1))
+        expected = max(expected, index + 1)
+
+    return gaps
 
 
 def account_operations_index(mongo, username):
@@ -93,7 +492,7 @@ def account_operations_index(mongo, username):
     start_index = 0
     # use projection to ensure covered query
     highest_index = list(
-        mongo.AccountOperations.find({'account': username}, {'_id': 0, 'index': 1}).
+        mongo.AccountOperations.find(synced_account_ops(username), {'_id': 0, 'index': 1}).
         sort("index", pymongo.DESCENDING).limit(1)
     )
     if highest_index:
@@ -109,12 +508,59 @@ def update_account_ops_quick(mongo, username, batch_size=200, steemd_instance=No
     # fetch latest records and update the db
     history = \
         Account(username,
-                steemd_instance=steemd_instance).history_reverse(batch_size=batch_size)
+                steemd_instance=steemd_instance or get_steemd()).history_reverse(batch_size=batch_size)
     for event in take(batch_size, history):
         if event['index'] < start_index:
             return
         with suppress(DuplicateKeyError):
-            mongo.AccountOperations.insert_one(json_expand(typify(event)))
+            mongo.AccountOperations.insert_one(normalize_operation(event))
+
+
+# op fields that hold account names, see `impacted_accounts`
+ACCOUNT_FIELDS = [
+    'account', 'account_to_recover', 'account_to_reset', 'agent', 'author',
+    'benefactor', 'comment_author', 'creator', 'curator', 'current_owner',
+    'current_reset_account', 'delegatee', 'delegator', 'from', 'from_account',
+    'new_account_name', 'new_recovery_account', 'open_owner', 'owner',
+    'parent_author', 'producer', 'proxy', 'publisher', 'receiver',
+    'recovery_account', 'reset_account', 'to', 'to_account', 'voter',
+    'who', 'witness', 'worker_account',
+]
+
+
+def impacted_accounts(op):
+    """ All accounts named by an op, like steemd's `get_impacted_accounts`.
+
+    A vote impacts both the voter and the author, a reply the parent
+    author as well, and so on. Used to fan out an op to account histories.
+    """
+    accounts = [op.get(x) for x in ACCOUNT_FIELDS]
+    for field in ['required_auths', 'required_posting_auths']:
+        accounts.extend(op.get(field) or [])
+    if op['type'] == 'pow2':
+        accounts.append(get_in(op, ['work', 1, 'input', 'worker_account']))
+    # `owner` is an authority rather than a name in account_create
+    return {x for x in accounts if x and isinstance(x, str)}
+
+
+def derive_account_operations(op):
+    """ Fan out an Operations entry into AccountOperations entries.
+
+    Every account impacted by the op (see `impacted_accounts`) gets an entry.
+    Since account history indexes are only known to steemd, derived entries
+    have no `index`, and their `_id` is derived from the op's own `_id`.
+    They are only written with `derived_account_ops`, which turns off
+    the account history sync over RPC.
+    """
+    return [
+        {
+            **op,
+            '_id': hashlib.sha1(('%s/%s' % (op['_id'], account)).encode()).hexdigest(),
+            'account': account,
+            'block': op['block_num'],
+        }
+        for account in sorted(impacted_accounts(op))
+    ]
 
 
 def find_latest_item(mongo, collection_name, field_name):
@@ -126,126 +572,158 @@ def find_latest_item(mongo, collection_name, field_name):
     return last_op[field_name]
 
 
-def parse_operation(op):
-    """ Update all relevant collections that this op impacts. """
-    op_type = op['type']
+# Operation Parsing
+# -----------------
+def _fields(*names):
+    """ Extract accounts from required op fields. """
+    return lambda op: [op[x] for x in names]
 
-    update_accounts_light = set()
-    update_accounts_full = set()
-    update_comments = set()
 
-    def construct_identifier():
-        return '@%s/%s' % (
-            op.get('author', op.get('comment_author')),
-            op.get('permlink', op.get('comment_permlink')),
-        )
+def _present_fields(*names):
+    """ Extract accounts from whichever of the op fields are present. """
+    return lambda op: keep_in_dict(op, list(names)).values()
 
-    def account_from_auths():
-        return first(op.get('required_auths', op.get('required_posting_auths')))
 
-    if op_type in ['account_create',
-                   'account_create_with_delegation']:
-        update_accounts_light.add(op['creator'])
-        update_accounts_full.add(op['new_account_name'])
+def _account_from_auths(op):
+    return [first(op.get('required_auths', op.get('required_posting_auths')))]
 
-    elif op_type in ['account_update',
-                     'withdraw_vesting',
-                     'claim_reward_balance',
-                     'return_vesting_delegation',
-                     'account_witness_vote']:
-        update_accounts_light.add(op['account'])
 
-    elif op_type == 'account_witness_proxy':
-        update_accounts_light.add(op['account'])
-        update_accounts_light.add(op['proxy'])
+def _pow2_worker(op):
+    return [op['work'][1]['input']['worker_account']]
 
-    elif op_type in ['author_reward', 'comment']:
-        update_accounts_light.add(op['author'])
-        update_comments.add(construct_identifier())
 
-    elif op_type == 'vote':
-        update_accounts_light.add(op['voter'])
-        update_comments.add(construct_identifier())
+def _comment_identifier(op):
+    return ['@%s/%s' % (
+        op.get('author', op.get('comment_author')),
+        op.get('permlink', op.get('comment_permlink')),
+    )]
 
-    elif op_type == 'cancel_transfer_from_savings':
-        update_accounts_light.add(op['from'])
 
-    elif op_type == 'change_recovery_account':
-        update_accounts_light.add(op['account_to_recover'])
+def _follow_accounts(op):
+    """ Accounts whose followers or following lists a follow op changes. """
+    if op.get('id') != 'follow' or not isinstance(op.get('json'), list):
+        return ()
+    cmd, payload = (op['json'] + [None, None])[:2]
+    if cmd != 'follow' or not isinstance(payload, dict):
+        return ()
+    return keep_in_dict(payload, ['follower', 'following']).values()
 
-    elif op_type == 'comment_benefactor_reward':
-        update_accounts_light.add(op['benefactor'])
 
-    elif op_type == ['convert',
-                     'fill_convert_request',
-                     'interest',
-                     'limit_order_cancel',
-                     'limit_order_create',
-                     'shutdown_witness',
-                     'witness_update']:
-        update_accounts_light.add(op['owner'])
+def _extras(extra, accounts):
+    """ Load `extra` (see `account_extras_loaders`) for the extracted accounts. """
+    return lambda op: [(x, extra) for x in accounts(op)]
+
+
+def _nothing(op):
+    return ()
 
-    elif op_type == 'curation_reward':
-        update_accounts_light.add(op['curator'])
 
-    elif op_type in ['custom', 'custom_json']:
-        update_accounts_light.add(account_from_auths())
+OperationHandler = namedtuple('OperationHandler',
+                              ['accounts', 'accounts_light', 'comments', 'extras'])
 
-    elif op_type == 'delegate_vesting_shares':
-        update_accounts_light.add(op['delegator'])
-        update_accounts_light.add(op['delegatee'])
 
-    elif op_type == 'delete_comment':
-        update_accounts_light.add(op['author'])
+def _handler(accounts=_nothing, accounts_light=_nothing, comments=_nothing, extras=_nothing):
+    return OperationHandler(accounts, accounts_light, comments, extras)
 
-    elif op_type in ['escrow_approve',
+
+_party_accounts = _present_fields('agent', 'from', 'to', 'who', 'receiver')
+
+# op type -> extractors of the accounts and comments that the op impacts
+operation_handlers = {
+    **dict.fromkeys(['account_create',
+                     'account_create_with_delegation'],
+                    _handler(accounts=_fields('new_account_name'),
+                             accounts_light=_fields('creator'))),
+    **dict.fromkeys(['account_update',
+                     'withdraw_vesting',
+                     'claim_reward_balance',
+                     'return_vesting_delegation',
+                     'account_witness_vote'],
+                    _handler(accounts_light=_fields('account'))),
+    'account_witness_proxy': _handler(accounts_light=_fields('account', 'proxy')),
+    **dict.fromkeys(['author_reward', 'comment'],
+                    _handler(accounts_light=_fields('author'),
+                             comments=_comment_identifier)),
+    'vote': _handler(accounts_light=_fields('voter'),
+                     comments=_comment_identifier),
+    'cancel_transfer_from_savings': _handler(accounts_light=_fields('from')),
+    'change_recovery_account': _handler(accounts_light=_fields('account_to_recover')),
+    'comment_benefactor_reward': _handler(accounts_light=_fields('benefactor')),
+    **dict.fromkeys(['convert',
+                     'fill_convert_request'],
+                    _handler(accounts_light=_fields('owner'),
+                             extras=_extras('conversion_requests', _fields('owner')))),
+    **dict.fromkeys(['interest',
+                     'limit_order_cancel',
+                     'limit_order_create',
+                     'shutdown_witness',
+                     'witness_update'],
+                    _handler(accounts_light=_fields('owner'))),
+    'curation_reward': _handler(accounts_light=_fields('curator'),
+                                extras=_extras('curation_stats', _fields('curator'))),
+    'custom': _handler(accounts_light=_account_from_auths),
+    'custom_json': _handler(accounts_light=_account_from_auths,
+                            extras=_extras('followers', _follow_accounts)),
+    'delegate_vesting_shares': _handler(accounts_light=_fields('delegator', 'delegatee')),
+    'delete_comment': _handler(accounts_light=_fields('author')),
+    **dict.fromkeys(['escrow_approve',
                      'escrow_dispute',
                      'escrow_release',
-                     'escrow_transfer']:
-        accs = keep_in_dict(op, ['agent', 'from', 'to', 'who', 'receiver']).values()
-        update_accounts_light.update(accs)
-
-    elif op_type == 'feed_publish':
-        update_accounts_light.add(op['publisher'])
+                     'escrow_transfer'],
+                    _handler(accounts_light=_party_accounts)),
+    'feed_publish': _handler(accounts_light=_fields('publisher')),
+    'fill_order': _handler(accounts_light=_fields('open_owner', 'current_owner')),
+    'fill_vesting_withdraw': _handler(accounts_light=_fields('to_account', 'from_account')),
+    'pow2': _handler(accounts_light=_pow2_worker),
+    **dict.fromkeys(['recover_account',
+                     'request_account_recovery'],
+                    _handler(accounts_light=_fields('account_to_recover'))),
+    'set_withdraw_vesting_route': _handler(
+        accounts_light=_fields('from_account', 'to_account'),
+        extras=_extras('withdrawal_routes', _fields('from_account'))),
+    **dict.fromkeys(['transfer',
+                     'transfer_from_savings',
+                     'transfer_to_savings',
+                     'transfer_to_vesting'],
+                    _handler(accounts_light=_party_accounts)),
+}
 
-    elif op_type in ['fill_order']:
-        update_accounts_light.add(op['open_owner'])
-        update_accounts_light.add(op['current_owner'])
 
-    elif op_type in ['fill_vesting_withdraw']:
-        update_accounts_light.add(op['to_account'])
-        update_accounts_light.add(op['from_account'])
+def parse_operation(op):
+    """ Update all relevant collections that this op impacts. """
+    return parse_operations([op])
 
-    elif op_type == 'pow2':
-        acc = op['work'][1]['input']['worker_account']
-        update_accounts_light.add(acc)
 
-    elif op_type in ['recover_account',
-                     'request_account_recovery']:
-        update_accounts_light.add(op['account_to_recover'])
+def parse_operations(ops):
+    """ Collect the accounts and comments that a batch of ops impacts.
 
-    elif op_type == 'set_withdraw_vesting_route':
-        update_accounts_light.add(op['from_account'])
-        update_accounts_light.add(op['to_account'])
-    elif op_type in ['transfer',
-                     'transfer_from_savings',
-                     'transfer_to_savings',
-                     'transfer_to_vesting']:
-        accs = keep_in_dict(op, ['agent', 'from', 'to', 'who', 'receiver']).values()
-        update_accounts_light.update(accs)
-
-    # # handle followers
-    # if op_type == 'custom_json':
-    #     with suppress(ValueError):
-    #         cmd, op_json = json.loads(op['json'])  # ['follow', {data...}]
-    #         if cmd == 'follow':
-    #             accs = keep_in_dict(op_json, ['follower', 'following']).values()
-    #             update_accounts_light.discard(first(accs))
-    #             update_accounts_light.discard(second(accs))
-    #             update_accounts_full.update(accs)
+    Returns a dict of unique `accounts` (full refresh), `accounts_light`
+    and `comments` identifiers, as well as the `account_extras` that need
+    to be loaded per account (see `refresh_accounts`).
+    """
+    accounts = set()
+    accounts_light = set()
+    comments = set()
+    account_extras = defaultdict(set)
+
+    for op in ops:
+        handler = operation_handlers.get(op['type'])
+        if handler:
+            accounts.update(handler.accounts(op))
+            accounts_light.update(handler.accounts_light(op))
+            comments.update(handler.comments(op))
+            for account, extra in handler.extras(op):
+                account_extras[account].add(extra)
+
+    for account in accounts:
+        account_extras[account].update(account_extras_loaders)
+    accounts.discard(None)
+    accounts_light.discard(None)
+    account_extras.pop(None, None)
 
     return {
-        'accounts': list(update_accounts_full),
-        'accounts_light': list(update_accounts_light),
-        'comments': list(update_comments),
+        'accounts': list(accounts),
+        'accounts_light': list(accounts_light),
+        'comments': list(comments),
+        'account_extras': {k: list(v) for k, v in account_extras.items()},
     }
@@ -0,0 +1,284 @@
+""" Process wide metrics, exposed in the Prometheus text format.
+
+Metrics are created (or looked up) by name on the shared `registry`::
+
+    rpc_errors = registry.counter('steemd_rpc_errors_total',
+                                  'Failed steemd calls', ['method', 'node'])
+    rpc_errors.inc(method='get_block', node=url)
+
+Set METRICS_PORT to serve them over HTTP (see `serve`), and
+METRICS_PERSIST_INTERVAL to persist them into `stats` (see `persist_every`).
+"""
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# serve metrics on this port, if set
+METRICS_PORT = os.getenv('METRICS_PORT')
+# seconds between persisting metrics into the `stats` collection, if set
+METRICS_PERSIST_INTERVAL = os.getenv('METRICS_PERSIST_INTERVAL')
+
+log = logging.getLogger(__name__)
+
+
+class Buckets(object):
+    """ A cumulative histogram, of latencies (in seconds) by default. """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, buckets=None):
+        if buckets:
+            self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def export(self):
+        return {
+            'buckets': dict(zip(map(_format_value, self.buckets), self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metric(object):
+    """ A metric with one value per combination of label values.
+
+    Args:
+        name: Metric name.
+        help: Description of the metric.
+        labels: Label names.
+        collect: Optional function that returns the current values
+        as a dict of label values tuple -> value, called on export.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(x, '')) for x in self.labels)
+
+    def snapshot(self):
+        if self.collect:
+            return dict(self.collect())
+        with self._lock:
+            return dict(self.values)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for key, value in sorted(self.snapshot().items()):
+            lines.append('%s%s %s' % (
+                self.name, _format_labels(zip(self.labels, key)), _format_value(value)))
+        return lines
+
+    def export(self):
+        return {'|'.join(k) or '_': v for k, v in self.snapshot().items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self.values:
+                self.values[key] = Buckets(self.buckets)
+            self.values[key].observe(value)
+
+    def time(self, **labels):
+        """ Time a block of code. """
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        with self._lock:
+            values = sorted((k, v.export()) for k, v in self.values.items())
+        for key, value in values:
+            labels = list(zip(self.labels, key))
+            for le, count in value['buckets'].items():
+                lines.append('%s_bucket%s %s' % (
+                    self.name, _format_labels(labels + [('le', le)]), count))
+            lines.append('%s_sum%s %s' % (
+                self.name, _format_labels(labels), _format_value(value['sum'])))
+            lines.append('%s_count%s %s' % (
+                self.name, _format_labels(labels), value['count']))
+        return lines
+
+    def export(self):
+        with self._lock:
+            return {'|'.join(k) or '_': v.export() for k, v in self.values.items()}
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry(object):
+    """ A set of metrics, looked up by name. """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels=(), **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, labels, **kwargs)
+            metric = self.metrics[name]
+        assert isinstance(metric, cls), '%s is a %s' % (name, metric.type)
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), collect=None) -> Gauge:
+        return self._get(Gauge, name, help, labels, collect=collect)
+
+    def histogram(self, name, help, labels=(), buckets=None) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        """ All the metrics, in the Prometheus text format. """
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda x: x.name)
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # ie. a collector that needs an unavailable RPC node
+                lines.append('# %s failed: %s' % (metric.name, e))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        """ All the metrics as a dict. """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        exported = {}
+        for metric in metrics:
+            try:
+                exported[metric.name] = metric.export()
+            except Exception:
+                continue
+        return exported
+
+    def persist(self, mongo, worker_name):
+        """ `$set` the metrics of a worker into the `stats` document. """
+        mongo.db['stats'].update_one(
+            {}, {'$set': {'metrics.%s' % worker_name: _mongo_safe(self.export())}},
+            upsert=True)
+
+
+registry = Registry()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _mongo_safe(data):
+    # label values (node urls) and bucket bounds contain dots
+    if isinstance(data, dict):
+        return {k.replace('.', '#'): _mongo_safe(v) for k, v in data.items()}
+    return data
+
+
+def _format_labels(labels):
+    labels = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for k, v in labels]
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % x for x in labels)
+
+
+# HTTP endpoint
+# -------------
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=METRICS_PORT, host='0.0.0.0'):
+    """ Serve the metrics over HTTP from a background thread. """
+    server = MetricsServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def persist_every(mongo, worker_name, interval=METRICS_PERSIST_INTERVAL):
+    """ Persist the metrics every `interval` seconds, from a background thread. """
+    def run():
+        while True:
+            time.sleep(float(interval))
+            try:
+                registry.persist(mongo, worker_name)
+            except Exception:
+                log.exception('Failed to persist metrics')
+
+    thread = threading.Thread(target=run, name='metrics-persist', daemon=True)
+    thread.start()
+    return thread
@@ -1,13 +1,34 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import atexit
+import datetime as dt
+import sys
+import threading
+import time
+import weakref
+from collections import defaultdict, namedtuple
+from pprint import pprint
+
 import pymongo
-from pymongo.errors import ConnectionFailure
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from metrics import registry
 
 MONGO_HOST = 'localhost'
 MONGO_PORT = 27017
 DB_NAME = 'SteemData'
 
+mongo_writes = registry.counter(
+    'mongo_writes_total', 'Mongo write requests', ['collection'])
+mongo_documents = registry.counter(
+    'mongo_documents_written_total', 'Documents inserted, upserted or modified', ['collection'])
+mongo_write_latency = registry.histogram(
+    'mongo_write_seconds', 'Latency of Mongo bulk writes', ['collection'])
+checkpoint_block = registry.gauge(
+    'checkpoint_block', 'Last block of the block based checkpoints', ['checkpoint'])
+
 
 class MongoStorage(object):
     def __init__(self, db_name=DB_NAME, host=MONGO_HOST, port=MONGO_PORT):
@@ -15,6 +36,8 @@ class MongoStorage(object):
             mongo_url = 'mongodb://%s:%s/%s' % (host, port, db_name)
             client = pymongo.MongoClient(mongo_url)
             self.db = client[db_name]
+            # allows worker processes to open their own connection
+            self.connection_args = dict(db_name=db_name, host=host, port=port)
 
         except ConnectionFailure as e:
             print('Can not connect to MongoDB server: %s' % e)
@@ -28,6 +51,23 @@ class MongoStorage(object):
             self.AccountOperations = self.db['AccountOperations']
             self.PriceHistory = self.db['PriceHistory']
 
+        self._indexer = None
+        self._ingestion = None
+
+    @property
+    def indexer(self):
+        """ The checkpoint manager shared by everything using this connection. """
+        if not self._indexer:
+            self._indexer = Indexer(self)
+        return self._indexer
+
+    @property
+    def ingestion(self):
+        """ The ingestion counters shared by everything using this connection. """
+        if not self._ingestion:
+            self._ingestion = IngestionStats(self)
+        return self._ingestion
+
     def list_collections(self):
         return self.db.collection_names()
 
@@ -35,109 +75,448 @@ class MongoStorage(object):
         for col in self.list_collections():
             self.db.drop_collection(col)
 
-    def ensure_indexes(self):
-        self.Blockchain.create_index('previous', unique=True)
-        self.Blockchain.create_index('block_id', unique=True)
-        self.Blockchain.create_index([('block_num', -1)])
-
-        self.Accounts.create_index('name', unique=True)
-
-        # Operations are using _id as unique index
-        self.Operations.create_index([('type', 1), ('timestamp', -1)])
-        self.Operations.create_index([('block_id', 1)])
-        self.Operations.create_index([('type', 1)])
-        self.Operations.create_index([('block_num', -1)])
-        self.Operations.create_index([('timestamp', -1)])
-        # partial indexes
-        self.Operations.create_index([('author', 1), ('permlink', 1)], sparse=True, background=True)
-        self.Operations.create_index([('to', 1)], sparse=True, background=True)
-        self.Operations.create_index([('from', 1)], sparse=True, background=True)
-        self.Operations.create_index([('memo', pymongo.HASHED)], sparse=True, background=True)
-
-        # AccountOperations are using _id as unique index
-        self.AccountOperations.create_index([('account', 1), ('type', 1), ('timestamp', -1)])
-        self.AccountOperations.create_index([('account', 1), ('type', 1)])
-        self.AccountOperations.create_index([('account', 1)])
-        self.AccountOperations.create_index([('type', 1)])
-        self.AccountOperations.create_index([('timestamp', -1)])
-        self.AccountOperations.create_index([('index', -1)])
-
-        self.Posts.create_index([('author', 1), ('permlink', 1)], unique=True)
-        self.Posts.create_index([('identifier', 1)], unique=True)
-        self.Posts.create_index([('author', 1)])
-        self.Posts.create_index([('created', -1)])
-        self.Posts.create_index([('json_metadata.app', 1)], background=True, sparse=True)
-        self.Posts.create_index([('json_metadata.users', 1)], background=True, sparse=True)
-        self.Posts.create_index([('json_metadata.tags', 1)], background=True, sparse=True)
-        self.Posts.create_index([('json_metadata.community', 1)], background=True, sparse=True)
-        self.Posts.create_index([('body', 'text'), ('title', 'text')], background=True)
-
-        self.Comments.create_index([('identifier', 1)], unique=True)
-        self.Comments.create_index([('parent_author', 1)])
-        self.Comments.create_index([('parent_permlink', 1)])
-        self.Comments.create_index([('author', 1)])
-        self.Comments.create_index([('permlink', 1)])
-        self.Comments.create_index([('created', -1)])
-        self.Comments.create_index([('body', 'text'), ('title', 'text')], background=True)
-
-        self.PriceHistory.create_index([('timestamp', -1)])
-
-        # 4 jesta's tools
-        self.Operations.create_index(
-            [('producer', 1), ('type', 1), ('timestamp', 1)],
-            sparse=True, background=True)
-        self.Operations.create_index(
-            [('curator', 1), ('type', 1), ('timestamp', 1)],
-            sparse=True, background=True)
-        self.Operations.create_index(
-            [('benefactor', 1), ('type', 1), ('timestamp', 1)],
-            sparse=True, background=True)
-        self.Operations.create_index(
-            [('author', 1), ('type', 1), ('timestamp', 1)],
-            sparse=True, background=True)
+    def ensure_indexes(self, defer=False):
+        """ Build the indexes of `index_spec` that don't exist yet.
+
+        Args:
+            defer: Leave out deferrable indexes, ie. during a bulk backfill.
+        """
+        for index in self.plan_indexes(defer=defer):
+            print('Building index %s.%s' % (index.collection, index_name(index.keys)))
+            self.db[index.collection].create_index(index.keys, **index.options)
+
+    def plan_indexes(self, defer=False):
+        """ Diff `index_spec` against the existing indexes.
+
+        Returns the list of indexes that need to be built.
+        """
+        existing = {}
+        plan = []
+        for index in index_spec:
+            if defer and index.deferrable:
+                continue
+            if index.collection not in existing:
+                existing[index.collection] = self.db[index.collection].index_information()
+            if index_name(index.keys) not in existing[index.collection]:
+                plan.append(index)
+        return plan
+
+    def index_report(self):
+        """ Find existing indexes that are unused, redundant or not in `index_spec`.
+
+        Usage counts (`$indexStats`) are reset on server restart.
+        """
+        report = {}
+        for collection in set(x.collection for x in index_spec):
+            specified = [index_name(x.keys) for x in index_spec if x.collection == collection]
+            info = self.db[collection].index_information()
+            keys = {name: [k for k, _ in x['key']] for name, x in info.items()}
+            usage = {
+                x['name']: x['accesses']['ops']
+                for x in self.db[collection].aggregate([{'$indexStats': {}}])
+            }
+            report[collection] = {
+                'unused': [k for k, v in usage.items() if not v and k != '_id_'],
+                'redundant': [
+                    name for name, fields in keys.items()
+                    if name != '_id_' and not info[name].get('unique') and any(
+                        other != name and other_fields[:len(fields)] == fields
+                        and len(other_fields) > len(fields)
+                        for other, other_fields in keys.items())
+                ],
+                'unknown': [x for x in info if x != '_id_' and x not in specified],
+            }
+        return report
+
+    def prune_indexes(self):
+        """ Drop the indexes that are not in `index_spec`. """
+        for collection, report in self.index_report().items():
+            for name in report['unknown']:
+                print('Dropping index %s.%s' % (collection, name))
+                self.db[collection].drop_index(name)
+
+
+# Indexes
+# -------
+Index = namedtuple('Index', ['collection', 'keys', 'options', 'deferrable'])
+
+
+def _index(collection, keys, deferrable=False, **options):
+    return Index(collection, keys, options, deferrable)
+
+
+def index_name(keys):
+    """ The default name Mongo gives to an index on `keys`. """
+    return '_'.join('%s_%s' % x for x in keys)
+
+
+# Indexes that are only used by queries can be `deferrable`,
+# and built once a bulk backfill is over.
+# Leave out prefixes of compound indexes, they are covered already.
+index_spec = [
+    _index('Blockchain', [('previous', 1)], unique=True),
+    _index('Blockchain', [('block_id', 1)], unique=True),
+    _index('Blockchain', [('block_num', -1)]),
+
+    _index('Accounts', [('name', 1)], unique=True),
+
+    # Operations are using _id as unique index
+    # the ingestion pipelines query by block_num (and type)
+    _index('Operations', [('block_num', -1)]),
+    _index('Operations', [('type', 1), ('block_num', 1)]),
+    _index('Operations', [('type', 1), ('timestamp', -1)], deferrable=True),
+    _index('Operations', [('block_id', 1)], deferrable=True),
+    _index('Operations', [('timestamp', -1)], deferrable=True),
+    # partial indexes
+    _index('Operations', [('author', 1), ('permlink', 1)],
+           deferrable=True, sparse=True, background=True),
+    _index('Operations', [('to', 1)], deferrable=True, sparse=True, background=True),
+    _index('Operations', [('from', 1)], deferrable=True, sparse=True, background=True),
+    _index('Operations', [('memo', pymongo.HASHED)],
+           deferrable=True, sparse=True, background=True),
+    # 4 jesta's tools
+    _index('Operations', [('producer', 1), ('type', 1), ('timestamp', 1)],
+           deferrable=True, sparse=True, background=True),
+    _index('Operations', [('curator', 1), ('type', 1), ('timestamp', 1)],
+           deferrable=True, sparse=True, background=True),
+    _index('Operations', [('benefactor', 1), ('type', 1), ('timestamp', 1)],
+           deferrable=True, sparse=True, background=True),
+    _index('Operations', [('author', 1), ('type', 1), ('timestamp', 1)],
+           deferrable=True, sparse=True, background=True),
+
+    # AccountOperations are using _id as unique index
+    # update_account_ops resumes from the highest index of an account
+    _index('AccountOperations', [('account', 1), ('index', -1)]),
+    _index('AccountOperations', [('account', 1), ('type', 1), ('timestamp', -1)],
+           deferrable=True),
+    _index('AccountOperations', [('type', 1)], deferrable=True),
+    _index('AccountOperations', [('timestamp', -1)], deferrable=True),
+    _index('AccountOperations', [('index', -1)], deferrable=True),
+
+    _index('Posts', [('author', 1), ('permlink', 1)], unique=True),
+    _index('Posts', [('identifier', 1)], unique=True),
+    _index('Posts', [('created', -1)]),
+    _index('Posts', [('json_metadata.app', 1)], background=True, sparse=True),
+    _index('Posts', [('json_metadata.users', 1)], background=True, sparse=True),
+    _index('Posts', [('json_metadata.tags', 1)], background=True, sparse=True),
+    _index('Posts', [('json_metadata.community', 1)], background=True, sparse=True),
+    _index('Posts', [('body', 'text'), ('title', 'text')], deferrable=True, background=True),
+
+    _index('Comments', [('identifier', 1)], unique=True),
+    _index('Comments', [('parent_author', 1)]),
+    _index('Comments', [('parent_permlink', 1)]),
+    _index('Comments', [('author', 1)]),
+    _index('Comments', [('permlink', 1)]),
+    _index('Comments', [('created', -1)]),
+    _index('Comments', [('body', 'text'), ('title', 'text')], deferrable=True, background=True),
+
+    _index('PriceHistory', [('timestamp', -1)]),
+]
 
 
 class Indexer(object):
-    def __init__(self, mongo):
+    """ Keep track of scraper checkpoints in the `_indexer` collection.
+
+    The in-memory state is authoritative for this process, and writes
+    are coalesced into at most one update per `flush_interval` seconds.
+    Checkpoints only ever move forward (`$max`), so parallel workers can't
+    regress each other's progress. Use `force=True` to reset a checkpoint.
+
+    Pending writes are flushed by `flush()`, and at interpreter exit.
+
+    Args:
+        mongo: MongoStorage instance.
+        flush_interval: Minimum number of seconds between checkpoint writes.
+    """
+
+    def __init__(self, mongo, flush_interval=5):
         self.coll = mongo.db['_indexer']
+        self.flush_interval = flush_interval
+        self.coll.update_one(
+            {}, {"$setOnInsert": {"operations_checkpoint": 1}}, upsert=True)
         self.instance = self.coll.find_one()
+        self.loaded = time.time()
 
-        if not self.instance:
-            self.coll.insert_one({
-                "operations_checkpoint": 1,
-            })
-            self.instance = self.coll.find_one()
+        self.state = {}
+        self.pending = {}
+        self.last_flush = time.time()
+        self._lock = threading.Lock()
+        _flushable.add(self)
 
     def get_checkpoint(self, name):
-        field = f'{name}_checkpoint'
-        return self.instance.get(field, 1)
+        return self._get(f'{name}_checkpoint')
+
+    def set_checkpoint(self, name, index, force=False):
+        self._set(f'{name}_checkpoint', index, force=force)
+
+    def get_range_checkpoint(self, name, start):
+        """ Checkpoint of the range of `name` beginning at `start`. """
+        return self._get(f'{name}_ranges.{start}', default=start)
+
+    def set_range_checkpoint(self, name, start, index):
+        self._set(f'{name}_ranges.{start}', index)
+
+    def clear_ranges(self, name):
+        """ Forget all the range checkpoints of `name`. """
+        self.flush()
+        field = f'{name}_ranges'
+        with self._lock:
+            self.state = {k: v for k, v in self.state.items()
+                          if not k.startswith(field + '.')}
+            self.instance.pop(field, None)
+            self.coll.update_one({}, {"$unset": {field: ''}})
+
+    def flush(self):
+        """ Write out the pending checkpoints. """
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+            if not pending:
+                return
+
+            update = {}
+            for field, (index, force) in pending.items():
+                update.setdefault('$set' if force else '$max', {})[field] = index
+            self.instance = self.coll.find_one_and_update(
+                {}, update, return_document=ReturnDocument.AFTER)
+            self.loaded = time.time()
+
+            # pick up progress made by other workers in the meantime
+            for field in pending:
+                self.state[field] = _get_path(self.instance, field)
+
+    def _get(self, field, default=1):
+        with self._lock:
+            if field in self.state:
+                return self.state[field]
+            # checkpoints of other workers (ie. `operations`) move on their own
+            if time.time() - self.loaded >= self.flush_interval:
+                self.instance = self.coll.find_one()
+                self.loaded = time.time()
+            return _get_path(self.instance, field, default)
+
+    def _set(self, field, index, force=False):
+        with self._lock:
+            if not force:
+                current = self.state.get(field, _get_path(self.instance, field, None))
+                index = _max(current, index)
+            self.state[field] = index
+            # a reset must not be lost to a later, coalesced `$max`
+            _, forced = self.pending.get(field, (None, False))
+            self.pending[field] = (index, force or forced)
 
-    def set_checkpoint(self, name, index):
-        field = f'{name}_checkpoint'
-        return self.coll.update_one({}, {"$set": {field: index}})
+        # `index` is the checkpoint that was kept, not a regressed one
+        if isinstance(index, int) and field.endswith('_checkpoint'):
+            checkpoint_block.set(index, checkpoint=field[:-len('_checkpoint')])
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+def _max(current, index):
+    """ The larger checkpoint, in the order of `$max` (numbers before strings). """
+    if current is None:
+        return index
+    return max(current, index, key=lambda x: (isinstance(x, str), x))
+
+
+def _get_path(document, field, default=1):
+    for key in field.split('.'):
+        if not isinstance(document, dict) or key not in document:
+            return default
+        document = document[key]
+    return document
+
+
+# checkpoints and counters with pending writes
+_flushable = weakref.WeakSet()
+
+
+@atexit.register
+def flush_all():
+    for x in list(_flushable):
+        x.flush()
+
+
+class BufferedWriter(object):
+    """ Buffer documents and write them in unordered `insert_many` batches.
+
+    Documents that already exist (DuplicateKeyError) are skipped individually,
+    any other write error is re-raised.
+
+    Args:
+        collection: pymongo collection to write into.
+        batch_size: Number of buffered documents that makes the writer due.
+        flush_interval: Seconds after which a non-empty buffer becomes due.
+        ingestion: IngestionStats to count the inserted documents in.
+    """
+
+    def __init__(self, collection, batch_size=1000, flush_interval=3, ingestion=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ingestion = ingestion
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def add(self, document):
+        self.buffer.append(document)
+
+    def is_due(self):
+        if len(self.buffer) >= self.batch_size:
+            return True
+        return bool(self.buffer) and \
+            time.time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        """ Write out the buffer. Returns the number of inserted documents. """
+        documents, self.buffer = self.buffer, []
+        self.last_flush = time.time()
+        if not documents:
+            return 0
+
+        name = self.collection.name
+        try:
+            with mongo_write_latency.time(collection=name):
+                result = self.collection.insert_many(documents, ordered=False)
+            inserted = len(result.inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(x.get('code') != 11000 for x in errors):
+                raise
+            inserted = e.details.get('nInserted', 0)
+        mongo_writes.inc(collection=name)
+        mongo_documents.inc(inserted, collection=name)
+
+        if self.ingestion:
+            self.ingestion.incr(self.collection.name, 'inserted', inserted)
+        return inserted
+
+
+class IngestionStats(object):
+    """ Count the documents written by the ingestion pipelines.
+
+    Counters are kept in memory, and added to the `ingestion` field
+    of the `stats` document with at most one `$inc` per `flush_interval`.
+
+    Args:
+        mongo: MongoStorage instance.
+        flush_interval: Minimum number of seconds between counter writes.
+    """
+
+    def __init__(self, mongo, flush_interval=5):
+        self.coll = mongo.db['stats']
+        self.flush_interval = flush_interval
+        self.pending = defaultdict(int)
+        self.last_flush = time.time()
+        self._lock = threading.Lock()
+        _flushable.add(self)
+
+    def incr(self, collection, field, n=1):
+        if not n:
+            return
+        with self._lock:
+            self.pending[f'ingestion.{collection}.{field}'] += n
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def record(self, collection, result):
+        """ Count the upserts and modifications of a bulk write result. """
+        if not result:
+            return
+        self.incr(collection, 'inserted', result.get('nInserted', 0))
+        self.incr(collection, 'upserted', result.get('nUpserted', 0))
+        self.incr(collection, 'modified', result.get('nModified', 0))
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, defaultdict(int)
+            self.last_flush = time.time()
+            if pending:
+                self.coll.update_one({}, {'$inc': dict(pending)}, upsert=True)
 
 
 class Stats(object):
-    def __init__(self, mongo):
+    """ Compile collection statistics into the `stats` document.
+
+    Document counts come from collection metadata, and are only verified
+    with an exact count every `exact_interval` seconds. Ingestion rates are
+    derived from the `IngestionStats` counters between two refreshes.
+
+    Args:
+        mongo: MongoStorage instance.
+        exact_interval: Seconds between exact document counts.
+    """
+
+    def __init__(self, mongo, exact_interval=3600 * 6):
         self.mongo = mongo
         self._stats = mongo.db['stats']
         self.stats = self._stats.find_one()
+        self.exact_interval = exact_interval
+        self.last_exact = 0
+        self._last_ingestion = None
+
+    def refresh(self, head_block_num=None):
+        exact = time.time() - self.last_exact >= self.exact_interval
+        stats = self._compile_stats(exact=exact)
+        stats.update(self._compile_rates())
+        if head_block_num:
+            stats['lag'] = self._compile_lag(head_block_num)
+        if exact:
+            self.last_exact = time.time()
+
+        # `$set`, so the ingestion counters are preserved
+        return self._stats.update_one({}, {'$set': stats}, upsert=True)
+
+    def _compile_stats(self, exact=False):
+        now = dt.datetime.utcnow()
+        stats = {
+            'dbSize': self.mongo.db.command('dbstats', 1000).get('storageSize', 1) / 1e6,
+            'updatedAt': now,
+        }
+        for k in self.mongo.list_collections():
+            stats[f'{k}.count'] = self.mongo.db[k].estimated_document_count()
+            stats[f'{k}.size'] = \
+                self.mongo.db.command('collstats', k).get('storageSize', 1) / 1e6
+            if exact:
+                stats[f'{k}.exactCount'] = self.mongo.db[k].count_documents({})
+                stats[f'{k}.exactCountAt'] = now
+        return stats
 
-    def refresh(self):
-        return self._stats.update({}, self._compile_stats(), upsert=True)
+    def _compile_lag(self, head_block_num):
+        """ Number of blocks every block based checkpoint is behind the head. """
+        checkpoints = self.mongo.db['_indexer'].find_one() or {}
+        return {
+            k[:-len('_checkpoint')]: head_block_num - v
+            for k, v in checkpoints.items()
+            if k.endswith('_checkpoint') and isinstance(v, int) and v > 0
+        }
 
-    def _compile_stats(self):
-        # pprint(self.mongo.db.command('collstats', 'Accounts'))
+    def _compile_rates(self):
+        """ Per second ingestion rates since the last refresh. """
+        ingestion = (self._stats.find_one({}, {'ingestion': 1}) or {}).get('ingestion', {})
+        now = time.time()
+        last, self._last_ingestion = self._last_ingestion, (now, ingestion)
+        if not last:
+            return {}
+
+        elapsed = max(now - last[0], 1e-6)
         return {
-            **{k: {
-                'count': self.mongo.db[k].find().count(),
-                'size': self.mongo.db.command('collstats', k).get('storageSize', 1) / 1e6,
-            }
-               for k in self.mongo.list_collections()},
-            'dbSize': self.mongo.db.command('dbstats', 1000).get('storageSize', 1) / 1e6
+            f'rates.{collection}.{field}':
+                (count - last[1].get(collection, {}).get(field, 0)) / elapsed
+            for collection, counters in ingestion.items()
+            for field, count in counters.items()
         }
 
 
 if __name__ == '__main__':
     mongo = MongoStorage()
-    Stats(mongo).refresh()
+    if sys.argv[1:] == ['indexes']:
+        pprint(mongo.index_report())
+    elif sys.argv[1:] == ['prune_indexes']:
+        mongo.prune_indexes()
+    else:
+        Stats(mongo).refresh()
@@ -0,0 +1,152 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from funcy import omit
+
+from methods import derived_account_ops
+from scraper import (
+    scrape_operations,
+    scrape_comments,
+    process_comments,
+    post_processing,
+    process_operations,
+    scrape_account_operations,
+    process_account_operations,
+)
+from metrics import registry
+from utils import log_exceptions, observe_batch
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+# operations of the complete blocks `first_block` to `last_block`
+Batch = namedtuple('Batch', ['operations', 'first_block', 'last_block'])
+
+queued_batches = registry.gauge(
+    'pipeline_queued_batches', 'Batches waiting for a pipeline stage', ['stage'])
+
+
+class Subscriber(object):
+    """ A pipeline stage, fed with freshly inserted operations.
+
+    Batches are processed in a background thread, straight from memory.
+    The queue is bounded, so a slow stage holds back the ingestion.
+
+    Whenever the stage checkpoint is behind a batch (after a cold start,
+    or a failed batch), the stage first catches up from Mongo with its
+    polling worker.
+
+    Args:
+        mongo: MongoStorage instance.
+        name: Name of the stage checkpoint.
+        process: A `fn(mongo, operations)` that processes a batch.
+        catch_up: The polling worker of the stage. It must return the new
+        checkpoint, or None if there is no more work.
+        types: Operation types to process, or None for all of them.
+        queue_size: Maximum number of queued batches.
+    """
+
+    def __init__(self, mongo, name, process, catch_up, types=None, queue_size=10):
+        self.mongo = mongo
+        self.name = name
+        self.process = process
+        self.catch_up = catch_up
+        self.types = types
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def publish(self, batch):
+        self.queue.put(batch)
+        queued_batches.set(self.queue.qsize(), stage=self.name)
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            queued_batches.set(self.queue.qsize(), stage=self.name)
+            if batch is None:
+                return
+            with log_exceptions():
+                self.handle(batch)
+
+    def handle(self, batch):
+        indexer = self.mongo.indexer
+        checkpoint = indexer.get_checkpoint(self.name)
+        if checkpoint >= batch.last_block:
+            return
+
+        while checkpoint < batch.first_block - 1:
+            index = self.catch_up(self.mongo)
+            if index is None:
+                break
+            checkpoint = index
+            log.info('[%s] caught up to %s' % (self.name, checkpoint))
+
+        operations = [
+            x for x in batch.operations
+            if x['block_num'] > checkpoint and (not self.types or x['type'] in self.types)
+        ]
+        if operations:
+            start_time = time.time()
+            self.process(self.mongo, operations)
+            observe_batch(self.name, len(operations), time.time() - start_time)
+        indexer.set_checkpoint(self.name, batch.last_block)
+
+
+class EventBus(object):
+    """ Publish batches of operations to all the subscribed stages. """
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        subscriber.start()
+
+    def publish(self, operations, first_block, last_block):
+        batch = Batch(operations, first_block, last_block)
+        for subscriber in self.subscribers:
+            subscriber.publish(batch)
+
+    def close(self):
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+
+def account_operations(mongo, operations):
+    """ `process_account_operations` for published operations, which still have their bodies. """
+    return process_account_operations(mongo, [omit(x, ['body']) for x in operations])
+
+
+def run_pipeline(mongo, queue_size=10):
+    """ Ingest operations, and process them in the same process.
+
+    This replaces the `scrape_operations`, `scrape_comments`,
+    `post_processing` (and `scrape_account_operations`) workers,
+    without reading the operations back from Mongo.
+    """
+    bus = EventBus()
+    bus.subscribe(Subscriber(
+        mongo, 'comments', process_comments, scrape_comments,
+        types={'comment'}, queue_size=queue_size))
+    bus.subscribe(Subscriber(
+        mongo, 'post_processing', process_operations, post_processing,
+        queue_size=queue_size))
+    if derived_account_ops:
+        bus.subscribe(Subscriber(
+            mongo, 'account_operations', account_operations,
+            scrape_account_operations, queue_size=queue_size))
+
+    try:
+        scrape_operations(mongo, publish=bus.publish)
+    finally:
+        bus.close()
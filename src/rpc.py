@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+import aiohttp
+from funcy import silent, get_in, chunks
+from steem.amount import Amount
+from steem.utils import parse_time
+
+from clients import node_pool, rpc_calls, rpc_errors, rpc_latency
+from utils import strip_dot_from_keys, safe_json_metadata
+
+log = logging.getLogger(__name__)
+
+
+class RPCError(Exception):
+    pass
+
+
+class AsyncSteemd(object):
+    """ Asyncio based steemd JSON-RPC client.
+
+    All requests share a single pooled HTTP session, and the number of
+    in-flight requests is capped by a semaphore. Calls can be grouped
+    into JSON-RPC batch requests.
+
+    Args:
+        url: steemd node url. Point this at a local fake server for testing.
+        By default, every request goes to the current best node of the node
+        pool, which is told about the latency and errors of the request.
+        concurrency: Maximum number of in-flight HTTP requests.
+        batch_size: Number of calls per JSON-RPC batch request.
+        retries: Number of retries for failed HTTP requests.
+        timeout: Request timeout in seconds.
+    """
+
+    def __init__(self, url=None, concurrency=1000, batch_size=50,
+                 retries=5, timeout=30, api='condenser_api'):
+        self.url = url
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.retries = retries
+        self.timeout = timeout
+        self.api = api
+
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._semaphore = None
+        self._ids = itertools.count(1)
+
+    def run(self, coro):
+        """ Run a coroutine on this client's event loop. """
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        if self._session:
+            self.run(self._session.close())
+        self.loop.close()
+
+    async def _ensure_session(self):
+        # aiohttp objects bind to the running loop, hence the lazy init
+        if not self._session:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def _post(self, method, payload):
+        await self._ensure_session()
+        for attempt in range(self.retries + 1):
+            # a retry goes to the best node at that time
+            node = self.url or node_pool.best()
+            start = time.time()
+            try:
+                async with self._semaphore:
+                    start = time.time()
+                    async with self._session.post(node, json=payload) as r:
+                        r.raise_for_status()
+                        response = await r.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                node_pool.observe(node, time.time() - start, error=True)
+                rpc_errors.inc(method=method, node=node)
+                if attempt == self.retries:
+                    raise
+                # exponential backoff with jitter
+                delay = min(2 ** attempt * 0.1, 10)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                continue
+
+            node_pool.observe(node, time.time() - start)
+            rpc_latency.observe(time.time() - start, method=method, node=node)
+            rpc_calls.inc(len(payload), method=method, node=node)
+            return response
+
+    async def call_batch(self, method, params_list):
+        """ Call `method` once per params entry, in a single batch request.
+
+        Returns the results in the same order as `params_list`.
+        Calls that fail on their own are logged and returned as None,
+        only a failed batch as a whole raises RPCError.
+        """
+        params_list = list(params_list)
+        ids = [next(self._ids) for _ in params_list]
+        payload = [
+            {'jsonrpc': '2.0', 'id': id_, 'method': 'call',
+             'params': [self.api, method, params]}
+            for id_, params in zip(ids, params_list)
+        ]
+        response = await self._post(method, payload)
+        if isinstance(response, dict):
+            # some nodes reply to a failed batch with a single error
+            raise RPCError(response.get('error', response))
+
+        by_id = {x.get('id'): x for x in response}
+        results = []
+        for id_, params in zip(ids, params_list):
+            item = by_id.get(id_, {})
+            if 'error' in item or 'result' not in item:
+                log.warning('%s%s failed: %s', method, params,
+                            item.get('error', 'missing response'))
+            results.append(item.get('result'))
+        return results
+
+    async def get_comments(self, identifiers):
+        """ Fetch and export many comments concurrently.
+
+        Returns the same dicts as `methods.get_comment`.
+        Comments that do not exist are left out.
+        """
+        batches = await asyncio.gather(*[
+            self._get_comments_batch(batch)
+            for batch in chunks(self.batch_size, list(identifiers))
+        ])
+        return [x for batch in batches for x in batch]
+
+    async def _get_comments_batch(self, identifiers):
+        params = [resolve_identifier(x) for x in identifiers]
+        posts = await self.call_batch('get_content', params)
+        posts = [x for x in posts if x and x.get('permlink')]
+        if not posts:
+            return []
+
+        reblogs = await self.call_batch(
+            'get_reblogged_by', [[x['author'], x['permlink']] for x in posts])
+        return [
+            safe_json_metadata(strip_dot_from_keys(export_post(post, reblogged_by or [])))
+            for post, reblogged_by in zip(posts, reblogs)
+        ]
+
+
+def resolve_identifier(identifier):
+    author, permlink = identifier.split('/', 1)
+    return [author.lstrip('@'), permlink]
+
+
+def export_post(post, reblogged_by=()):
+    """ Convert a raw `get_content` result like `steem.post.Post.export()` does. """
+    post = {
+        **post,
+        'identifier': '@%s/%s' % (post['author'], post['permlink']),
+        'reblogged_by': [x for x in reblogged_by if x != post['author']],
+        'body_length': len(post.get('body', '')),
+    }
+
+    for key in ['active', 'cashout_time', 'created',
+                'last_payout', 'last_update', 'max_cashout_time']:
+        post[key] = parse_time(post.get(key, '1970-01-01T00:00:00'))
+
+    for key in ['total_payout_value', 'max_accepted_payout',
+                'pending_payout_value', 'curator_payout_value',
+                'total_pending_payout_value', 'promoted']:
+        post[key] = dict(Amount(post.get(key, '0.000 SBD')))
+
+    post['json_metadata'] = silent(json.loads)(post.get('json_metadata', '{}')) or {}
+    post['tags'] = []
+    post['community'] = ''
+    if isinstance(post['json_metadata'], dict):
+        if post['depth'] == 0:
+            tags = [post['parent_permlink']]
+            tags += get_in(post, ['json_metadata', 'tags'], default=[])
+            post['tags'] = list(dict.fromkeys(x for x in tags if isinstance(x, str)))
+        post['community'] = get_in(post, ['json_metadata', 'community'], default='')
+
+    post['active_votes'] = [
+        {**vote, 'time': parse_time(vote['time'])} if 'time' in vote else vote
+        for vote in post.get('active_votes', [])
+    ]
+
+    return post
+
+
+_local = threading.local()
+
+
+def shared_steemd():
+    """ A long-lived AsyncSteemd instance, so connections are reused across batches.
+
+    Event loops can't be shared between threads, hence one instance per thread.
+    """
+    if not getattr(_local, 'steemd', None):
+        _local.steemd = AsyncSteemd()
+    return _local.steemd
+
+
+def fetch_comments(identifiers, steemd=None):
+    """ Blocking helper to fetch and export many comments at once. """
+    steemd = steemd or shared_steemd()
+    return steemd.run(steemd.get_comments(identifiers))
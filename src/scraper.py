@@ -1,41 +1,42 @@
 import datetime as dt
 import logging
+import multiprocessing
 import time
+from collections import OrderedDict
 from contextlib import suppress
+from functools import partial
 
-from funcy import (
-    compose,
-    lpluck,
-    lkeep,
-    flatten,
-    merge_with,
-    keep,
-    lfilter,
-    silent,
-)
-from pymongo import UpdateOne
-from pymongo.errors import DuplicateKeyError
-from steem import Steem
 from steem.blockchain import Blockchain
-from steemdata.utils import (
-    json_expand,
-    typify,
-)
 from toolz import partition_all
 
 from methods import (
     update_account,
+    update_accounts,
+    refresh_accounts,
     update_account_ops,
     update_account_ops_quick,
-    upsert_comment_chain,
-    parse_operation,
-    get_comment,
+    upsert_comment_chains,
+    upsert_comments,
+    parse_operations,
+    derive_account_operations,
+    derived_account_ops,
 )
-from mongostorage import Indexer, Stats
+from clients import get_steemd
+from metrics import registry
+from mongostorage import BufferedWriter, MongoStorage, Stats, checkpoint_block
+from rpc import fetch_comments
 from utils import (
+    BlockWindow,
+    accounts_refresh_cache,
+    comments_refresh_cache,
     fetch_price_feed,
     get_usernames_batch,
-    strip_dot_from_keys,
+    head_block,
+    log_exceptions,
+    normalize_operation,
+    observe_batch,
+    prefetch,
+    stop_at_end,
     thread_multi,
 )
 
@@ -45,105 +46,182 @@ log.setLevel(logging.INFO)
 
 # Operations
 # ----------
-def scrape_operations(mongo):
-    """Fetch all operations (including virtual) from last known block forward."""
-    indexer = Indexer(mongo)
+def scrape_operations(mongo, batch_size=1000, flush_interval=3, publish=None):
+    """Fetch all operations (including virtual) from last known block forward.
+
+    Every inserted batch is passed on to `publish`, if given (see `pipeline.py`).
+    """
+    indexer = mongo.indexer
     last_block = indexer.get_checkpoint('operations')
     log.info('\n> Fetching operations, starting with block %d...' % last_block)
 
-    blockchain = Blockchain(mode="irreversible")
-    history = blockchain.history(
+    blockchain = Blockchain(steemd_instance=get_steemd(), mode="irreversible")
+    history = stop_at_end(blockchain.history(
         start_block=last_block,
+    ))
+    insert_operations(
+        mongo, history, partial(indexer.set_checkpoint, 'operations'), last_block,
+        batch_size=batch_size,
+        flush_interval=flush_interval,
+        publish=publish,
     )
-    for operation in history:
-        # insert operation
-        with suppress(DuplicateKeyError):
-            transform = compose(strip_dot_from_keys, json_expand, typify)
-            mongo.Operations.insert_one(transform(operation))
 
-        # if this is a new block, checkpoint it, and schedule batch processing
+
+def insert_operations(mongo, history, set_checkpoint, last_block,
+                      batch_size=1000, flush_interval=3, publish=None):
+    """ Bulk insert a stream of operations.
+
+    Operations are buffered and written in unordered bulk inserts.
+    The buffer is only flushed on block boundaries, so `set_checkpoint`
+    can safely advance to the last block of every flushed batch.
+
+    Once inserted, batches are passed on to
+    `publish(operations, first_block, last_block)`, if given.
+
+    Returns the last block seen in a (finite) history.
+    """
+    writer = BufferedWriter(
+        mongo.Operations,
+        batch_size=batch_size,
+        flush_interval=flush_interval,
+        ingestion=mongo.ingestion,
+    )
+    def flush(block_num):
+        operations = writer.buffer
+        writer.flush()
+        set_checkpoint(block_num)
+        if publish and operations:
+            publish(operations, flushed + 1, block_num)
+        return block_num
+
+    flushed = last_block
+    for operation in history:
+        # if this is a new block, the previous one is complete
         if operation['block_num'] != last_block:
-            last_block = operation['block_num']
-            indexer.set_checkpoint('operations', last_block - 1)
+            if writer.is_due():
+                flushed = flush(operation['block_num'] - 1)
 
+            last_block = operation['block_num']
             if last_block % 10 == 0:
-                log.info("Checkpoint: %s (%s)" % (
-                    last_block,
-                    blockchain.steem.hostname
-                ))
+                log.info("Checkpoint: %s" % last_block)
+
+        writer.add(normalize_operation(operation))
+
+    writer.flush()
+    return last_block
+
+
+def backfill_operations(mongo, range_size=100000, processes=8):
+    """ Backfill Operations in parallel block ranges.
+
+    The `[checkpoint, last_irreversible)` interval is split into ranges
+    that are fetched by a process pool. Every range keeps its own checkpoint
+    in `_indexer`, so a crashed range resumes where it left off.
+    Once the ranges meet the head, the deferred indexes are built,
+    and the live tail takes over.
+    """
+    indexer = mongo.indexer
+    while True:
+        start_block = indexer.get_checkpoint('operations')
+        end_block = head_block.last_irreversible_block_num
+        if end_block - start_block <= range_size:
+            break
+
+        ranges = [(x, min(x + range_size, end_block))
+                  for x in range(start_block, end_block, range_size)]
+        log.info('\n> Backfilling blocks %d - %d in %d ranges...' % (
+            start_block, end_block, len(ranges)))
+
+        worker = partial(backfill_operations_range,
+                         connection_args=mongo.connection_args)
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes) as pool:
+            for start, end in pool.imap_unordered(worker, ranges):
+                log.info('Backfilled range %d - %d' % (start, end))
+
+        indexer.set_checkpoint('operations', end_block - 1)
+        indexer.clear_ranges('operations')
+
+    # indexes that were deferred for the backfill
+    mongo.ensure_indexes()
+    scrape_operations(mongo)
+
+
+def backfill_operations_range(block_range, connection_args):
+    """ Fetch and insert all operations in `[start, end)`. Runs in a worker process. """
+    start, end = block_range
+    mongo = MongoStorage(**connection_args)
+    indexer = mongo.indexer
+
+    last_block = indexer.get_range_checkpoint('operations', start)
+    if last_block >= end - 1:
+        return block_range
+
+    history = stop_at_end(Blockchain(steemd_instance=get_steemd(), mode="irreversible").history(
+        start_block=last_block,
+        end_block=end - 1,
+    ))
+    insert_operations(mongo, history,
+                      partial(indexer.set_range_checkpoint, 'operations', start),
+                      last_block)
+    indexer.set_range_checkpoint('operations', start, end - 1)
+    # pool processes don't run atexit handlers
+    indexer.flush()
+    return block_range
 
 
 # Posts, Comments
 # ---------------
-def scrape_comments(mongo, batch_size=250, max_workers=50):
+def scrape_comments(mongo, window=None):
     """ Parse operations and post-process for comment/post extraction. """
-    indexer = Indexer(mongo)
+    window = window or comments_window
+    indexer = mongo.indexer
     start_block = indexer.get_checkpoint('comments')
+    start_time = time.time()
 
-    query = {
-        "type": "comment",
-        "block_num": {
-            "$gt": start_block,
-            "$lte": start_block + batch_size,
-        }
-    }
     projection = {
         '_id': 0,
         'block_num': 1,
         'author': 1,
         'permlink': 1,
     }
-    results = list(mongo.Operations.find(query, projection=projection))
-    identifiers = set(f"{x['author']}/{x['permlink']}" for x in results)
+    results = next_operations_window(
+        mongo, {'type': 'comment'}, start_block, window.size, projection)
 
-    # handle an edge case when we are too close to the head,
-    # and the batch contains no work to do
-    if not results and is_recent(start_block, days=1):
+    # we are at the head, and there is no work to do
+    if results is None:
         return
 
-    # get Post.export() results in parallel
-    raw_comments = thread_multi(
-        fn=get_comment,
-        fn_args=[None],
-        dep_args=list(identifiers),
-        max_workers=max_workers,
-        re_raise_errors=True,
-    )
-    raw_comments = lkeep(raw_comments)
+    results = Tally(results)
+    upserted = process_comments(mongo, results)
 
-    # split into root posts and comments
-    posts = lfilter(lambda x: x['depth'] == 0, raw_comments)
-    comments = lfilter(lambda x: x['depth'] > 0, raw_comments)
+    index = results.block_num
+    indexer.set_checkpoint('comments', index)
+    window.update(results.count, time.time() - start_time)
 
-    # Mongo upsert many
     log_output = ''
-    if posts:
-        r = mongo.Posts.bulk_write(
-            [UpdateOne({'identifier': x['identifier']},
-                       {'$set': {**x, 'updatedAt': dt.datetime.utcnow()}},
-                       upsert=True)
-             for x in posts],
-            ordered=False,
-        )
-        log_output += \
-            f'(Posts: {r.upserted_count} upserted, {r.modified_count} modified) '
-    if comments:
-        r = mongo.Comments.bulk_write(
-            [UpdateOne({'identifier': x['identifier']},
-                       {'$set': {**x, 'updatedAt': dt.datetime.utcnow()}},
-                       upsert=True)
-             for x in comments],
-            ordered=False,
-        )
+    for collection, r in upserted.items():
         log_output += \
-            f'(Comments: {r.upserted_count} upserted, {r.modified_count} modified) '
+            f'({collection}: {r["nUpserted"]} upserted, {r["nModified"]} modified) '
+    log.info(f'Checkpoint: {index} {log_output}')
+    return index
 
-    # We are only querying {type: 'comment'} blocks and sometimes
-    # the gaps are larger than the batch_size.
-    index = silent(max)(lpluck('block_num', results)) or (start_block + batch_size)
-    indexer.set_checkpoint('comments', index)
 
-    log.info(f'Checkpoint: {index} {log_output}')
+def process_comments(mongo, operations):
+    """ Upsert the comments of a batch of `comment` operations.
+
+    Returns the bulk write results by collection name.
+    """
+    identifiers = set(f"@{x['author']}/{x['permlink']}" for x in operations)
+
+    # skip comments that were refreshed moments ago
+    identifiers = comments_refresh_cache.refresh(identifiers)
+
+    # get Post.export() equivalent results concurrently
+    raw_comments = fetch_comments(identifiers)
+
+    # Mongo upsert many
+    return upsert_comments(mongo, raw_comments)
 
 
 # Accounts, AccountOperations
@@ -156,8 +234,8 @@ def scrape_all_users(mongo, quick=False):
     Ideally, this would only need to run once, because "scrape_accounts"
     takes care of accounts that need to be updated in each block.
     """
-    steem = Steem()
-    indexer = Indexer(mongo)
+    steem = get_steemd()
+    indexer = mongo.indexer
 
     account_checkpoint = indexer.get_checkpoint('accounts')
     if account_checkpoint:
@@ -168,123 +246,341 @@ def scrape_all_users(mongo, quick=False):
     for username in usernames:
         log.info('Updating @%s' % username)
         update_account(mongo, username, load_extras=True)
-        if quick:
+        if derived_account_ops:
+            log.info('Updated @%s' % username)
+        elif quick:
             update_account_ops_quick(mongo, username)
+            log.info('Updated @%s' % username)
         else:
-            update_account_ops(mongo, username)
+            r = update_account_ops(mongo, username)
+            log.info('Updated @%s (%s ops fetched, %s inserted, %s skipped)' % (
+                username, r['fetched'], r['inserted'], r['skipped']))
         indexer.set_checkpoint('accounts', username)
-        log.info('Updated @%s' % username)
 
     # this was the last batch
     if account_checkpoint and len(usernames) < 1000:
-        indexer.set_checkpoint('accounts', -1)
+        indexer.set_checkpoint('accounts', -1, force=True)
 
 
-# Posts, Comments, Accounts, AccountOperations
-# --------------------------------------------
-def post_processing(mongo, batch_size=100, max_workers=50):
-    indexer = Indexer(mongo)
-    start_block = indexer.get_checkpoint('post_processing')
+def scrape_all_users_sharded(mongo, shards=4, max_workers=20, quick=False):
+    """ Run one pass of `scrape_all_users` over the alphabetically
+    sharded username space, with one worker process per shard.
+
+    Every shard keeps its own checkpoint in `_indexer`, and resumes from it.
+    """
+    worker = partial(scrape_users_shard,
+                     shards=shards,
+                     connection_args=mongo.connection_args,
+                     max_workers=max_workers,
+                     quick=quick)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(shards) as pool:
+        for shard in pool.imap_unordered(worker, range(shards)):
+            log.info('Shard %d/%d completed' % (shard + 1, shards))
+
+
+def scrape_users_shard(shard, shards, connection_args, max_workers=20, quick=False):
+    """ Refresh all the accounts in a shard. Runs in a worker process. """
+    mongo = MongoStorage(**connection_args)
+    indexer = mongo.indexer
+    steem = get_steemd()
+    lower, upper = username_shard(shard, shards)
+    checkpoint = 'accounts_shard_%d_of_%d' % (shard, shards)
+
+    last_user = indexer.get_checkpoint(checkpoint)
+    if not isinstance(last_user, str):
+        last_user = lower
+    start_progress = username_progress(last_user, lower, upper)
+    start_time = time.time()
+
+    while True:
+        batch = get_usernames_batch(last_user, steem)
+        usernames = [x for x in batch
+                     if x > last_user and (not upper or x < upper)]
+        if not usernames:
+            break
+
+        update_accounts(mongo, usernames, load_extras=True, max_workers=max_workers)
+        if not derived_account_ops:
+            list(thread_multi(
+                fn=update_account_ops_quick if quick else update_account_ops,
+                fn_args=[mongo, None],
+                dep_args=usernames,
+                max_workers=max_workers,
+                re_raise_errors=False,
+                pool='account_ops',
+            ))
+
+        last_user = usernames[-1]
+        indexer.set_checkpoint(checkpoint, last_user)
+
+        progress = username_progress(last_user, lower, upper)
+        done = max(progress - start_progress, 1e-6)
+        eta = (time.time() - start_time) * (1 - progress) / done
+        log.info('[shard %d/%d] @%s (%.2f%%, ETA %s)' % (
+            shard + 1, shards, last_user, progress * 100,
+            dt.timedelta(seconds=int(eta))))
+
+        if len(batch) < 1000 or len(usernames) < len(batch) - 1:
+            break
+
+    # start over on the next pass
+    indexer.set_checkpoint(checkpoint, lower, force=True)
+    # pool processes don't run atexit handlers
+    indexer.flush()
+    return shard
+
+
+# account names start with a letter, and contain [a-z0-9.-]
+_username_chars = '-.0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def username_shard(shard, shards):
+    """ Return the `[lower, upper)` bounds of a shard. The last shard has no upper bound. """
+    letters = _username_chars[12:]
+    lower = letters[shard * len(letters) // shards]
+    upper = None
+    if shard + 1 < shards:
+        upper = letters[(shard + 1) * len(letters) // shards]
+    return lower, upper
+
+
+def username_progress(username, lower, upper, depth=4):
+    """ Estimate how far `username` is into the `[lower, upper)` range. """
+
+    def position(name):
+        base = len(_username_chars)
+        return sum(
+            (_username_chars.find(c) + 1) / (base + 1) ** (i + 1)
+            for i, c in enumerate(name[:depth])
+        )
+
+    start = position(lower)
+    end = position(upper) if upper else 1
+    return min(max((position(username) - start) / (end - start), 0), 1)
+
+
+def scrape_account_operations(mongo, batch_size=100):
+    """ Fan out new Operations into AccountOperations, without any RPC calls. """
+    if not derived_account_ops:
+        raise RuntimeError('scrape_account_operations requires DERIVED_ACCOUNT_OPS')
+
+    indexer = mongo.indexer
+    start_block = indexer.get_checkpoint('account_operations')
+    start_time = time.time()
+
+    # Operations are only complete up to their checkpoint,
+    # `scrape_operations` or a backfill may still be filling in later blocks
+    index = min(start_block + batch_size, indexer.get_checkpoint('operations'))
+    if index <= start_block:
+        return
 
     query = {
         "block_num": {
             "$gt": start_block,
-            "$lte": start_block + batch_size,
+            "$lte": index,
         }
     }
+    # bodies are left out of AccountOperations (see `remove_body`)
+    results = list(mongo.Operations.find(query, projection={'body': 0}))
+
+    inserted = process_account_operations(mongo, results)
+
+    indexer.set_checkpoint('account_operations', index)
+    observe_batch('account_operations', len(results), time.time() - start_time)
+
+    log.info('Checkpoint: %s - %s account operations' % (index, inserted))
+    return index
+
+
+def process_account_operations(mongo, operations):
+    """ Insert the AccountOperations of a batch of operations. Returns the inserted count.
+
+    Bodies are left out of AccountOperations (see `remove_body`),
+    so `operations` are expected without them.
+    """
+    writer = BufferedWriter(mongo.AccountOperations, ingestion=mongo.ingestion)
+    for op in operations:
+        for account_op in derive_account_operations(op):
+            writer.add(account_op)
+    return writer.flush()
+
+
+# Posts, Comments, Accounts, AccountOperations
+# --------------------------------------------
+def post_processing(mongo, window=None, max_workers=50):
+    window = window or post_processing_window
+    indexer = mongo.indexer
+    start_block = indexer.get_checkpoint('post_processing')
+    start_time = time.time()
+
     projection = {
         '_id': 0,
         'body': 0,
         'json_metadata': 0,
     }
-    results = list(mongo.Operations.find(query, projection=projection))
-    batches = map(parse_operation, results)
+    results = next_operations_window(mongo, {}, start_block, window.size, projection)
 
-    # handle an edge case when we are too close to the head,
-    # and the batch contains no work to do
-    if not results and is_recent(start_block, days=1):
+    # we are at the head, and there is no work to do
+    if results is None:
         return
 
-    # squash for duplicates
-    def custom_merge(*args):
-        return list(set(keep(flatten(args))))
-
-    batch_items = merge_with(custom_merge, *batches)
+    results = Tally(results)
+    batch_items = process_operations(mongo, results, max_workers=max_workers)
 
-    # upsert comments (recursively)
-    list(thread_multi(
-        fn=upsert_comment_chain,
-        fn_args=[mongo, None],
-        dep_args=batch_items['comments'],
-        fn_kwargs=dict(recursive=True),
-        max_workers=max_workers,
-        re_raise_errors=False,
-    ))
-
-    # only process accounts if the blocks are recent
-    # scrape_all_users should take care of stale updates
-    if is_recent(start_block, days=10):
-        accounts = set(batch_items['accounts_light'] +
-                       batch_items['accounts'])
-        list(thread_multi(
-            fn=update_account,
-            fn_args=[mongo, None],
-            dep_args=list(accounts),
-            fn_kwargs=dict(load_extras=False),
-            max_workers=max_workers,
-            re_raise_errors=False,
-        ))
-        list(thread_multi(
-            fn=update_account_ops_quick,
-            fn_args=[mongo, None],
-            dep_args=list(accounts),
-            fn_kwargs=None,
-            max_workers=max_workers,
-            re_raise_errors=False,
-        ))
-
-    index = max(lpluck('block_num', results))
+    index = results.block_num
     indexer.set_checkpoint('post_processing', index)
+    window.update(results.count, time.time() - start_time)
 
-    log.info("Checkpoint: %s - %s comments, %s accounts (+%s full)" % (
+    log.info("Checkpoint: %s - %s comments, %s accounts (+%s full), %s blocks behind" % (
         index,
         len(batch_items['comments']),
         len(batch_items['accounts_light']),
         len(batch_items['accounts']),
+        head_block.lag(index),
     ))
+    return index
+
+
+def process_operations(mongo, operations, max_workers=50):
+    """ Refresh the comments and accounts impacted by a batch of operations.
+
+    Returns the `parse_operations` results.
+    """
+    operations = Tally(operations)
+    batch_items = parse_operations(operations)
+
+    # upsert comments (recursively)
+    # failed comments are skipped, but a failed batch holds the checkpoint back
+    comments = comments_refresh_cache.refresh(batch_items['comments'])
+    upsert_comment_chains(mongo, comments)
+
+    # only process accounts if the blocks are recent
+    # scrape_all_users should take care of stale updates
+    if operations.block_num and is_recent(operations.block_num, days=10):
+        # accounts with extras to load are never held back
+        extras = batch_items['account_extras']
+        accounts = accounts_refresh_cache.refresh(
+            set(batch_items['accounts_light'] + batch_items['accounts']) - set(extras))
+        accounts = {**dict.fromkeys(accounts, []), **extras}
+        with log_exceptions():
+            refresh_accounts(mongo, accounts)
+        if not derived_account_ops:
+            list(thread_multi(
+                fn=update_account_ops_quick,
+                fn_args=[mongo, None],
+                dep_args=list(accounts),
+                fn_kwargs=None,
+                max_workers=max_workers,
+                re_raise_errors=False,
+                pool='accounts',
+            ))
+
+    return batch_items
+
+
+# Block Windows
+# -------------
+# scrape_comments makes an RPC call per comment, post_processing per account
+comments_window = BlockWindow(size=250, target_ops=1000, name='comments')
+post_processing_window = BlockWindow(size=100, target_ops=5000, name='post_processing')
+
+
+def next_operations_window(mongo, query, start_block, size, projection=None):
+    """ Stream the operations matching `query` in the next `size` blocks.
+
+    The window starts at the first matching block after `start_block`,
+    so empty gaps are jumped over with a single indexed lookup.
+    It never goes past the `operations` checkpoint, as block ranges past it
+    may still be filled in (ie. by `backfill_operations`).
+    Returns None if there are no matching operations yet.
+    """
+    last_block = mongo.indexer.get_checkpoint('operations')
+    first = mongo.Operations.find_one(
+        {**query, 'block_num': {'$gt': start_block, '$lte': last_block}},
+        projection={'_id': 0, 'block_num': 1},
+        sort=[('block_num', 1)],
+    )
+    if not first:
+        return None
+
+    query = {
+        **query,
+        'block_num': {
+            '$gte': first['block_num'],
+            '$lte': min(first['block_num'] + size - 1, last_block),
+        }
+    }
+    return mongo.Operations.find(query, projection=projection)
+
+
+class Tally(object):
+    """ Count the operations streamed through, and track the highest block_num. """
+
+    def __init__(self, operations):
+        self.operations = operations
+        self.count = 0
+        self.block_num = None
+
+    def __iter__(self):
+        for op in self.operations:
+            self.count += 1
+            if not self.block_num or op['block_num'] > self.block_num:
+                self.block_num = op['block_num']
+            yield op
 
 
 # Blockchain
 # ----------
-def scrape_blockchain(mongo):
-    s = Steem()
+def scrape_blockchain(mongo, fetch_workers=4, window=8):
+    s = get_steemd()
+    verifier = ChainVerifier(mongo)
     # see how far behind we are
-    missing = list(range(last_block_num(mongo), s.last_irreversible_block_num))
+    missing = list(range(last_block_num(mongo), head_block.last_irreversible_block_num))
 
     # if we are far behind blockchain head
-    # split work in chunks of 100
+    # split work in chunks of 100, and keep up to `window`
+    # chunks in flight while the previous ones are being inserted
     if len(missing) > 100:
-        for batch in partition_all(100, missing):
-            results = s.get_blocks(batch)
-            insert_blocks(mongo, results)
+        chunks = prefetch(
+            s.get_blocks,
+            partition_all(100, missing),
+            max_workers=fetch_workers,
+            window=window,
+        )
+        for results in chunks:
+            insert_blocks(mongo, results, verifier=verifier)
 
     # otherwise continue as normal
-    blockchain = Blockchain(mode="irreversible")
+    blockchain = Blockchain(steemd_instance=get_steemd(), mode="irreversible")
     hist = blockchain.stream_from(start_block=last_block_num(mongo), full_blocks=True)
-    insert_blocks(mongo, hist)
+    insert_blocks(mongo, hist, verifier=verifier, batch_size=1)
 
 
-def insert_blocks(mongo, full_blocks):
+def insert_blocks(mongo, full_blocks, verifier=None, batch_size=100):
+    """ Verify chain continuity and bulk insert blocks.
+
+    Args:
+        mongo: mongodb instance
+        full_blocks: An iterable of blocks, in order.
+        verifier: A ChainVerifier that is shared across calls.
+        batch_size: Number of blocks per insert. Use 1 for live streams.
+    """
+    if not verifier:
+        verifier = ChainVerifier(mongo)
+
+    writer = BufferedWriter(mongo.Blockchain, batch_size=batch_size,
+                            ingestion=mongo.ingestion)
     for block in full_blocks:
         if not block.get('block_num'):
             block['block_num'] = int(block['block_id'][:8], base=16)
 
-        if block['block_num'] > 1:
-            assert block_id_exists(mongo, block['previous']), \
-                'Missing Previous Block (%s)' % block['previous']
+        verifier.verify(block)
+        writer.add(block)
+        if writer.is_due():
+            writer.flush()
 
-        with suppress(DuplicateKeyError):
-            mongo.db['Blockchain'].insert_one(block)
+    writer.flush()
 
 
 def block_id_exists(mongo, block_id: str):
@@ -293,6 +589,29 @@ def block_id_exists(mongo, block_id: str):
         {'block_id': block_id}, {'_id': 0, 'block_id': 1})
 
 
+class ChainVerifier(object):
+    """ Check that the `previous` block of every block is known.
+
+    Recently verified block ids are kept in a LRU, so the database is only
+    queried on a cache miss, ie. for the first block after a restart.
+    """
+
+    def __init__(self, mongo, maxsize=10000):
+        self.mongo = mongo
+        self.maxsize = maxsize
+        self.recent = OrderedDict()
+
+    def verify(self, block):
+        if block['block_num'] > 1 and block['previous'] not in self.recent:
+            assert block_id_exists(self.mongo, block['previous']), \
+                'Missing Previous Block (%s)' % block['previous']
+
+        self.recent[block['block_id']] = block['block_num']
+        self.recent.move_to_end(block['block_id'])
+        if len(self.recent) > self.maxsize:
+            self.recent.popitem(last=False)
+
+
 def last_block_num(mongo) -> int:
     last_block = mongo.db['Blockchain'].find_one(
         filter={},
@@ -303,15 +622,21 @@ def last_block_num(mongo) -> int:
 
 
 def is_recent(block_num, days):
-    head_block_num = Steem().steemd.head_block_number
-    return block_num > head_block_num - 20 * 60 * 24 * days
+    return head_block.lag(block_num) < 20 * 60 * 24 * days
+
+
+# checkpoints set by this process, measured against the current head
+registry.gauge(
+    'checkpoint_lag_blocks', 'Blocks a checkpoint is behind the head', ['checkpoint'],
+    collect=lambda: {k: head_block.lag(v) for k, v in checkpoint_block.snapshot().items()})
 
 
 # Misc
 # ----
 def refresh_dbstats(mongo):
+    stats = Stats(mongo)
     while True:
-        Stats(mongo).refresh()
+        stats.refresh(head_block_num=head_block.last_irreversible_block_num)
         time.sleep(60)
 
 
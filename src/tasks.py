@@ -5,8 +5,12 @@ from celery import Celery
 
 from methods import (
     update_account,
+    refresh_accounts,
+    account_extras_loaders,
     update_account_ops_quick,
+    derived_account_ops,
     upsert_comment_chain,
+    upsert_comment_chains,
     find_latest_item,
 )
 from mongostorage import (
@@ -16,14 +20,14 @@ from mongostorage import (
     MONGO_PORT,
 )
 from utils import (
+    accounts_refresh_cache,
+    comments_refresh_cache,
     log_exceptions,
     thread_multi,
     time_delta,
 )
 
-# override a node for perf reasons
-_custom_node = True
-
+# steemd nodes are configured in clients.py (STEEMD_NODES, STEEMD_NODE)
 use_multi_threading = os.getenv('MULTI_THREADING', True)
 num_threads = int(os.getenv('MULTI_THREADING_MAX', 10))
 
@@ -81,7 +85,8 @@ tasks = new_celery('tasks')
 @tasks.task(ignore_result=True)
 def update_account_async(account_name, load_extras=False):
     update_account(mongo, account_name, load_extras=load_extras)
-    update_account_ops_quick(mongo, account_name)
+    if not derived_account_ops:
+        update_account_ops_quick(mongo, account_name)
 
 
 @tasks.task(ignore_result=True)
@@ -93,19 +98,15 @@ def update_comment_async(post_identifier, recursive=False):
 def batch_update_async(batch_items: dict):
     # todo break this batch into posts and account updates
 
-    if use_multi_threading:
-        with log_exceptions():
-            thread_multi(
-                fn=upsert_comment_chain,
-                fn_args=[mongo, None],
-                dep_args=batch_items['comments'],
-                fn_kwargs=dict(recursive=True),
-                max_workers=10,
-            )
-    else:
-        for identifier in batch_items['comments']:
-            with log_exceptions():
-                upsert_comment_chain(mongo, identifier, recursive=True)
+    # coalesce refreshes of hot posts and busy accounts
+    batch_items = {
+        **batch_items,
+        'comments': list(comments_refresh_cache.refresh(batch_items['comments'])),
+        'accounts_light': list(accounts_refresh_cache.refresh(batch_items['accounts_light'])),
+    }
+
+    with log_exceptions():
+        upsert_comment_chains(mongo, batch_items['comments'])
 
     # if we're lagging by a large margin, don't bother updating accounts
     lag = time_delta(find_latest_item(mongo, 'Posts', 'created'))
@@ -114,44 +115,42 @@ def batch_update_async(batch_items: dict):
 
     if use_multi_threading:
         with log_exceptions():
-            thread_multi(
-                fn=update_account,
-                fn_args=[mongo, None],
-                dep_args=batch_items['accounts_light'],
-                fn_kwargs=dict(load_extras=False),
-                max_workers=num_threads,
-            )
-            thread_multi(
-                fn=update_account_ops_quick,
-                fn_args=[mongo, None],
-                dep_args=batch_items['accounts_light'],
-                fn_kwargs=None,
-                max_workers=num_threads,
-            )
+            refresh_accounts(mongo, {
+                **dict.fromkeys(batch_items['accounts_light'], []),
+                **batch_items.get('account_extras', {}),
+            })
+            if not derived_account_ops:
+                list(thread_multi(
+                    fn=update_account_ops_quick,
+                    fn_args=[mongo, None],
+                    dep_args=batch_items['accounts_light'],
+                    fn_kwargs=None,
+                    max_workers=num_threads,
+                    pool='accounts',
+                ))
     else:
         for account_name in batch_items['accounts_light']:
             with log_exceptions():
                 update_account(mongo, account_name, load_extras=False)
-                update_account_ops_quick(mongo, account_name)
+                if not derived_account_ops:
+                    update_account_ops_quick(mongo, account_name)
 
     if use_multi_threading:
         with log_exceptions():
-            thread_multi(
-                fn=update_account,
-                fn_args=[mongo, None],
-                dep_args=batch_items['accounts'],
-                fn_kwargs=dict(load_extras=True),
-                max_workers=num_threads,
-            )
-            thread_multi(
-                fn=update_account_ops_quick,
-                fn_args=[mongo, None],
-                dep_args=batch_items['accounts'],
-                fn_kwargs=None,
-                max_workers=num_threads,
-            )
+            refresh_accounts(mongo, dict.fromkeys(
+                batch_items['accounts'], list(account_extras_loaders)))
+            if not derived_account_ops:
+                list(thread_multi(
+                    fn=update_account_ops_quick,
+                    fn_args=[mongo, None],
+                    dep_args=batch_items['accounts'],
+                    fn_kwargs=None,
+                    max_workers=num_threads,
+                    pool='accounts',
+                ))
     else:
         for account_name in batch_items['accounts']:
             with log_exceptions():
                 update_account(mongo, account_name, load_extras=True)
-                update_account_ops_quick(mongo, account_name)
+                if not derived_account_ops:
+                    update_account_ops_quick(mongo, account_name)
@@ -1,12 +1,22 @@
+import json
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from typing import List, Any, Union
 
 from funcy import contextmanager
-from steem import Steem
 from steemdata.helpers import simple_cache, create_cache
 from steemdata.markets import Markets
+from steem.utils import parse_time
+
+from clients import get_steemd
+from metrics import registry
 
 usernames_cache = create_cache()
 
@@ -48,7 +58,7 @@ def refresh_username_list():
 
 def get_all_usernames(last_user=-1, steem=None):
     if not steem:
-        steem = Steem()
+        steem = get_steemd()
 
     usernames = steem.lookup_accounts(last_user, 1000)
     batch = []
@@ -61,7 +71,7 @@ def get_all_usernames(last_user=-1, steem=None):
 
 def get_usernames_batch(last_user=-1, steem=None):
     if not steem:
-        steem = Steem()
+        steem = get_steemd()
 
     return steem.lookup_accounts(last_user, 1000)
 
@@ -84,15 +94,91 @@ def time_delta(item_time):
     return delta.seconds
 
 
+def stop_at_end(history):
+    """ End a `Blockchain.history` stream at its `end_block`.
+
+    `history` raises StopIteration past `end_block`, which becomes
+    a RuntimeError inside generators since Python 3.7 (PEP 479).
+    """
+    try:
+        yield from history
+    except RuntimeError as e:
+        if not isinstance(e.__cause__, StopIteration):
+            raise
+
+
 def strip_dot_from_keys(data: dict, replace_char='#') -> dict:
     """ Return a dictionary safe for MongoDB entry.
 
     ie. `{'foo.bar': 'baz'}` becomes `{'foo#bar': 'baz'}`
     """
+    def strip(value):
+        if type(value) == dict:
+            return strip_dot_from_keys(value, replace_char)
+        if type(value) == list:
+            return [strip(x) for x in value]
+        return value
+
     new_ = dict()
     for k, v in data.items():
-        if type(v) == dict:
-            v = strip_dot_from_keys(v)
+        if '.' in k:
+            k = k.replace('.', replace_char)
+        new_[k] = strip(v)
+    return new_
+
+
+_amount = re.compile(r'^(\d+\.\d+) (STEEM|SBD|VESTS)$')
+_time = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$')
+
+
+def _normalize(value, typed=True, replace_char='#'):
+    """ Strip dots from keys, and `typify` values if `typed`, in one walk. """
+    if type(value) == dict:
+        return {
+            (k.replace('.', replace_char) if '.' in k else k):
+                _normalize(v, typed, replace_char)
+            for k, v in value.items()
+        }
+    if type(value) in (list, set):
+        return [_normalize(x, typed, replace_char) for x in value]
+    if typed and type(value) == str:
+        # cheap checks first, most strings are neither
+        if value.endswith(('STEEM', 'SBD', 'VESTS')):
+            amount = _amount.match(value)
+            if amount:
+                return {'amount': float(amount.group(1)), 'asset': amount.group(2)}
+        elif len(value) == 19 and value[10] == 'T' and _time.match(value):
+            return _parse_time(value)
+    return value
+
+
+@lru_cache(maxsize=1024)
+def _parse_time(value):
+    # operations of a block share their timestamp
+    return parse_time(value)
+
+
+def normalize_operation(op: dict, remove_body=False, replace_char='#') -> dict:
+    """ Prepare an operation for MongoDB in a single pass.
+
+    Same as `compose(strip_dot_from_keys, json_expand, typify)`, with
+    `remove_body` before `strip_dot_from_keys` if `remove_body` is set.
+    Expanded `json` is not typified, and dots are stripped inside lists too.
+    """
+    new_ = dict()
+    for k, v in op.items():
+        if k == 'json':
+            v = _normalize(v, True, replace_char)
+            if type(v) == str:
+                try:
+                    v = json.loads(v)
+                except ValueError:
+                    v = {}
+                v = _normalize(v, False, replace_char)
+        elif k == 'body' and remove_body and op.get('type') == 'comment':
+            v = ''
+        else:
+            v = _normalize(v, True, replace_char)
         if '.' in k:
             k = k.replace('.', replace_char)
         new_[k] = v
@@ -124,6 +210,188 @@ def safe_json_metadata(post: dict) -> dict:
     }
 
 
+class HeadBlockTracker(object):
+    """ Keep track of the chain head, shared across a process.
+
+    The head and last irreversible block numbers are refreshed lazily,
+    at most once every `ttl` seconds, with a single RPC call.
+    """
+
+    def __init__(self, ttl=3, steem=None):
+        self.ttl = ttl
+        self._steem = steem
+        self._lock = threading.Lock()
+        self._updated = 0
+        self._head_block_number = 0
+        self._last_irreversible_block_num = 0
+
+    def refresh(self):
+        with self._lock:
+            if time.time() - self._updated < self.ttl:
+                return
+            steem = self._steem or get_steemd()
+            props = steem.get_dynamic_global_properties()
+            self._head_block_number = props['head_block_number']
+            self._last_irreversible_block_num = props['last_irreversible_block_num']
+            self._updated = time.time()
+
+    @property
+    def head_block_number(self) -> int:
+        self.refresh()
+        return self._head_block_number
+
+    @property
+    def last_irreversible_block_num(self) -> int:
+        self.refresh()
+        return self._last_irreversible_block_num
+
+    def lag(self, block_num) -> int:
+        """ How many blocks `block_num` is behind the head. """
+        return max(self.head_block_number - block_num, 0)
+
+
+head_block = HeadBlockTracker()
+
+
+# ------------------
+# Refresh Coalescing
+# ------------------
+class RefreshCache(object):
+    """ Coalesce repeated refreshes of the same key within a time window.
+
+    The first refresh of a key goes through right away. Further requests
+    within `ttl` seconds are held back, and a single trailing refresh is
+    released by `due()` once the window has passed, so the final state
+    is always fetched.
+
+    Args:
+        ttl: Length of the coalescing window in seconds.
+        maxsize: Number of keys to remember. Least recently used keys are
+        evicted first, and evicted keys with a pending refresh become due.
+    """
+
+    def __init__(self, ttl=60, maxsize=100000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._refreshed = OrderedDict()
+        self._pending = set()
+        self._evicted = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def filter(self, keys) -> set:
+        """ Return the keys that should be refreshed now. """
+        now = time.time()
+        refresh = set()
+        with self._lock:
+            for key in set(keys):
+                last_refresh = self._refreshed.get(key)
+                if last_refresh and now - last_refresh < self.ttl:
+                    self._pending.add(key)
+                    self.hits += 1
+                else:
+                    self._refreshed[key] = now
+                    self._pending.discard(key)
+                    self.misses += 1
+                    refresh.add(key)
+                self._refreshed.move_to_end(key)
+
+            while len(self._refreshed) > self.maxsize:
+                key, _ = self._refreshed.popitem(last=False)
+                if key in self._pending:
+                    self._pending.discard(key)
+                    self._evicted.add(key)
+        return refresh
+
+    def due(self) -> set:
+        """ Return held back keys whose window has passed (trailing refreshes). """
+        now = time.time()
+        with self._lock:
+            due = {x for x in self._pending
+                   if now - self._refreshed[x] >= self.ttl}
+            for key in due:
+                self._refreshed[key] = now
+            self._pending -= due
+            due |= self._evicted
+            self._evicted = set()
+        return due
+
+    def refresh(self, keys) -> set:
+        """ Keys to refresh now, including the trailing refreshes that are due. """
+        return self.filter(keys) | self.due()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'pending': len(self._pending) + len(self._evicted),
+                'size': len(self._refreshed),
+            }
+
+
+# shared between scrape_comments, post_processing and the celery tasks
+refresh_ttl = int(os.getenv('REFRESH_CACHE_TTL', 60))
+comments_refresh_cache = RefreshCache(ttl=refresh_ttl)
+accounts_refresh_cache = RefreshCache(ttl=refresh_ttl)
+
+
+# -----------------
+# Adaptive Batching
+# -----------------
+class BlockWindow(object):
+    """ Size block windows by the number of operations they contain.
+
+    After every batch, the window is scaled towards `target_ops` operations
+    and `target_latency` seconds per batch, whichever is more restrictive.
+    Scaling is damped to at most halving or doubling per batch.
+
+    Args:
+        size: Initial window size in blocks.
+        target_ops: Number of operations per batch to aim for.
+        target_latency: Seconds per batch to aim for.
+        min_size: Smallest window size in blocks.
+        max_size: Largest window size in blocks.
+        name: Stage name to record batch metrics under, if any.
+    """
+
+    def __init__(self, size=100, target_ops=2000, target_latency=10,
+                 min_size=1, max_size=10000, name=None):
+        self.name = name
+        self.size = size
+        self.target_ops = target_ops
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def update(self, ops, latency):
+        """ Resize the window after a batch of `ops` took `latency` seconds. """
+        scale = min(self.target_ops / max(ops, 1),
+                    self.target_latency / max(latency, 1e-3))
+        scale = min(max(scale, 0.5), 2)
+        self.size = int(min(max(self.size * scale, self.min_size), self.max_size))
+        if self.name:
+            observe_batch(self.name, ops, latency)
+            window_size.set(self.size, stage=self.name)
+        return self.size
+
+
+batch_operations = registry.histogram(
+    'stage_batch_operations', 'Operations per batch', ['stage'],
+    buckets=(1, 10, 100, 1000, 10000, 100000))
+batch_latency = registry.histogram(
+    'stage_batch_seconds', 'Seconds per batch', ['stage'])
+window_size = registry.gauge(
+    'stage_window_blocks', 'Block window size', ['stage'])
+
+
+def observe_batch(stage, ops, latency):
+    """ Record the size and latency of a batch processed by `stage`. """
+    batch_operations.observe(ops, stage=stage)
+    batch_latency.observe(latency, stage=stage)
+
+
 # ---------------
 # Multi-Threading
 # ---------------
@@ -147,13 +415,105 @@ def dependency_injection(fn_args, dep_args):
     return args
 
 
+class WorkerPool(object):
+    """ A long-lived thread pool that keeps track of its load.
+
+    Args:
+        name: Name of the pool, used as a thread name prefix.
+        max_workers: Number of threads in the pool.
+    """
+
+    def __init__(self, name, max_workers=100):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=name,
+        )
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.total_latency = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self.queued += 1
+        return self.executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latency = time.time() - start
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.total_latency += latency
+            pool_task_latency.observe(latency, pool=self.name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'avg_latency': self.total_latency / max(self.completed, 1),
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name='default', max_workers=100) -> WorkerPool:
+    """ Get a named, process wide worker pool. It is created on first use.
+
+    Pools are keyed by name and size, so callers that ask for a different
+    `max_workers` under the same name do not inherit the first caller's size.
+
+    Tasks running on a pool must not wait on other tasks submitted to
+    the same pool, as that deadlocks once every thread is waiting.
+    """
+    key = (name, max_workers)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = WorkerPool(name, max_workers=max_workers)
+        return _pools[key]
+
+
+def pool_stats():
+    """ Queue depth, active threads and task latency of every pool. """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [x.stats() for x in pools]
+
+
+pool_task_latency = registry.histogram(
+    'pool_task_seconds', 'Latency of worker pool tasks', ['pool'])
+registry.gauge(
+    'pool_queued', 'Tasks waiting for a worker pool thread', ['pool'],
+    collect=lambda: {(x['name'],): x['queued'] for x in pool_stats()})
+registry.gauge(
+    'pool_active', 'Busy worker pool threads', ['pool'],
+    collect=lambda: {(x['name'],): x['active'] for x in pool_stats()})
+
+
 def thread_multi(
         fn,
         fn_args: List[Any],
         dep_args: List[Union[Any, List[Any]]],
         fn_kwargs=None,
         max_workers=100,
-        re_raise_errors=True):
+        re_raise_errors=True,
+        pool='default',
+        ordered=False):
     """ Run a function /w variable inputs concurrently.
 
     Args:
@@ -162,22 +522,64 @@ def thread_multi(
         displaced trough `dep_args`.
         dep_args: A list of lists of arguments to displace in `fn_args`.
         fn_kwargs: Keyword arguments that `fn` takes.
-        max_workers: A cap of threads to run in parallel.
+        max_workers: A cap of tasks submitted to the pool at once.
         re_raise_errors: Throw exceptions that happen in the worker pool.
+        pool: A WorkerPool, or the name of a shared pool. Do not call
+        `thread_multi` from a task running on the same pool, it deadlocks.
+        ordered: Yield results in the order of `dep_args`, rather than as completed.
     """
     if not fn_kwargs:
         fn_kwargs = dict()
 
     fn_args = ensure_list(fn_args)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = (executor.submit(fn, *dependency_injection(fn_args, args), **fn_kwargs)
-                   for args in dep_args)
+    if not isinstance(pool, WorkerPool):
+        pool = get_pool(pool, max_workers=max_workers)
+
+    def submit(args):
+        return pool.submit(fn, *dependency_injection(fn_args, args), **fn_kwargs)
 
-        for future in as_completed(futures):
+    # only keep `max_workers` tasks in flight, and submit
+    # the remaining ones as the previous tasks complete
+    dep_args = iter(dep_args)
+    pending = deque(submit(x) for x in islice(dep_args, max_workers))
+
+    while pending:
+        if ordered:
+            done = [pending.popleft()]
+        else:
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            pending = deque(not_done)
+
+        for future in done:
+            for args in islice(dep_args, 1):
+                pending.append(submit(args))
             try:
                 yield future.result()
             except Exception as e:
                 log_exception()
                 if re_raise_errors:
                     raise e
+
+
+def prefetch(fn, batches, max_workers=4, window=8):
+    """ Map `fn` over `batches` in a thread pool, yielding results in order.
+
+    At most `window` batches are in flight at any time. The caller consumes
+    results while the next batches are being fetched, and a slow consumer
+    stalls further submissions, so memory stays bounded.
+
+    Args:
+        fn: A function that takes a single batch.
+        batches: An iterable of batches.
+        max_workers: Number of fetcher threads.
+        window: Maximum number of submitted, but not yet consumed batches.
+    """
+    return thread_multi(
+        fn=fn,
+        fn_args=[None],
+        dep_args=([x] for x in batches),
+        max_workers=window,
+        pool=get_pool('prefetch', max_workers=max_workers),
+        ordered=True,
+    )
@@ -1,10 +1,12 @@
 import multiprocessing
 import os
+import signal
 import sys
 import time
 from contextlib import suppress
 from multiprocessing.pool import Pool
 
+import metrics
 from mongostorage import (
     MongoStorage,
     DB_NAME,
@@ -13,32 +15,65 @@ from mongostorage import (
 )
 from scraper import (
     scrape_all_users,
+    scrape_all_users_sharded,
     scrape_operations,
+    backfill_operations,
     scrape_prices,
     refresh_dbstats,
     scrape_comments,
+    scrape_account_operations,
     post_processing,
 )
+from pipeline import run_pipeline
 from utils import log_exception
 
 
+def terminate(signum, frame):
+    # turn SIGTERM into SystemExit, so pending checkpoints get flushed
+    sys.exit(0)
+
+
 def run(worker_name):
+    signal.signal(signal.SIGTERM, terminate)
     mongo = MongoStorage(
         db_name=os.getenv('DB_NAME', DB_NAME),
         host=os.getenv('DB_HOST', MONGO_HOST),
         port=os.getenv('DB_PORT', MONGO_PORT))
 
+    if metrics.METRICS_PORT:
+        try:
+            metrics.serve()
+        except OSError:
+            # ie. another worker of `run_multi` is serving on this port
+            log_exception()
+    if metrics.METRICS_PERSIST_INTERVAL:
+        metrics.persist_every(mongo, worker_name)
+
+    # build missing indexes once, rather than on every retry
+    if worker_name in ('scrape_operations', 'pipeline'):
+        mongo.ensure_indexes()
+    elif worker_name == 'backfill_operations':
+        # backfill_operations builds the deferred indexes when it is done
+        mongo.ensure_indexes(defer=True)
+
     while True:
         try:
             if worker_name == 'scrape_operations':
-                mongo.ensure_indexes()
                 scrape_operations(mongo)
+            elif worker_name == 'backfill_operations':
+                backfill_operations(mongo)
+            elif worker_name == 'pipeline':
+                run_pipeline(mongo)
             elif worker_name == 'scrape_comments':
                 scrape_comments(mongo)
+            elif worker_name == 'scrape_account_operations':
+                scrape_account_operations(mongo)
             elif worker_name == 'post_processing':
                 post_processing(mongo)
             elif worker_name == 'scrape_all_users':
                 scrape_all_users(mongo, quick=False)
+            elif worker_name == 'scrape_all_users_sharded':
+                scrape_all_users_sharded(mongo, shards=int(os.getenv('SHARDS', 4)))
             elif worker_name == 'scrape_prices':
                 scrape_prices(mongo)
             elif worker_name == 'refresh_dbstats':
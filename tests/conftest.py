@@ -0,0 +1,180 @@
+import os
+import sys
+
+import pytest
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mongostorage import IngestionStats  # noqa: E402
+
+
+class FakeCursor(object):
+    def __init__(self, documents):
+        self.documents = list(documents)
+
+    def sort(self, key, direction=1):
+        self.documents.sort(key=lambda x: x.get(key, 0), reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.documents = self.documents[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class FakeInsertManyResult(object):
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class FakeUpdateResult(object):
+    def __init__(self, modified_count=0, upserted_count=0):
+        self.modified_count = modified_count
+        self.upserted_count = upserted_count
+
+
+class FakeBulkWriteResult(object):
+    def __init__(self):
+        self.bulk_api_result = {'nUpserted': 0, 'nModified': 0}
+
+
+class FakeCollection(object):
+    """ An in-memory stand-in for the few pymongo collection methods used here. """
+
+    def __init__(self, name, documents=()):
+        self.name = name
+        self.documents = []
+        for document in documents:
+            self.insert_one(document)
+
+    def _matches(self, document, query):
+        for key, condition in query.items():
+            if isinstance(condition, dict):
+                if '$exists' in condition and (key in document) != condition['$exists']:
+                    return False
+                if key not in document:
+                    if set(condition) - {'$exists'}:
+                        return False
+                    continue
+                value = document[key]
+                for op, bound in condition.items():
+                    if op == '$gt' and not value > bound:
+                        return False
+                    if op == '$gte' and not value >= bound:
+                        return False
+                    if op == '$lt' and not value < bound:
+                        return False
+                    if op == '$lte' and not value <= bound:
+                        return False
+                    if op == '$in' and value not in bound:
+                        return False
+            elif document.get(key) != condition:
+                return False
+        return True
+
+    def find(self, query=None, projection=None):
+        documents = [x for x in self.documents if self._matches(x, query or {})]
+        if projection:
+            fields = [k for k, v in projection.items() if v and k != '_id']
+            if fields:
+                documents = [{k: x[k] for k in fields if k in x} for x in documents]
+        return FakeCursor(documents)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        cursor = self.find(filter, projection)
+        for key, direction in sort or []:
+            cursor.sort(key, direction)
+        return next(iter(cursor), None)
+
+    def count_documents(self, query):
+        return len(self.find(query).documents)
+
+    def insert_one(self, document):
+        document.setdefault('_id', len(self.documents))
+        if any(x.get('_id') == document['_id'] for x in self.documents):
+            raise DuplicateKeyError('duplicate _id', 11000)
+        self.documents.append(document)
+
+    def update_one(self, filter, update, upsert=False):
+        matches = self.find(filter).documents
+        if matches:
+            result = FakeUpdateResult(modified_count=1)
+        elif upsert:
+            self.insert_one(dict(filter))
+            matches = self.documents[-1:]
+            result = FakeUpdateResult(upserted_count=1)
+        else:
+            return FakeUpdateResult()
+
+        document = matches[0]
+        document.update(update.get('$set', {}))
+        for field, n in update.get('$inc', {}).items():
+            document[field] = document.get(field, 0) + n
+        return result
+
+    def bulk_write(self, requests, ordered=True):
+        result = FakeBulkWriteResult()
+        for x in requests:
+            r = self.update_one(x._filter, x._doc, upsert=x._upsert)
+            result.bulk_api_result['nModified'] += r.modified_count
+            result.bulk_api_result['nUpserted'] += r.upserted_count
+        return result
+
+    def insert_many(self, documents, ordered=True):
+        inserted, errors = [], []
+        for i, document in enumerate(documents):
+            try:
+                self.insert_one(document)
+                inserted.append(document['_id'])
+            except DuplicateKeyError:
+                errors.append({'index': i, 'code': 11000})
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted)})
+        return FakeInsertManyResult(inserted)
+
+
+class FakeIndexer(object):
+    def __init__(self, **checkpoints):
+        self.checkpoints = checkpoints
+
+    def get_checkpoint(self, name):
+        return self.checkpoints.get(name, 1)
+
+    def set_checkpoint(self, name, index, force=False):
+        self.checkpoints[name] = index
+
+    def get_range_checkpoint(self, name, start):
+        return self.checkpoints.get('%s_ranges.%s' % (name, start), start)
+
+    def set_range_checkpoint(self, name, start, index):
+        self.checkpoints['%s_ranges.%s' % (name, start)] = index
+
+    def flush(self):
+        pass
+
+
+class FakeDB(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection(name)
+        return self[name]
+
+
+class FakeMongo(object):
+    def __init__(self, **collections):
+        self.db = FakeDB((name, FakeCollection(name, documents))
+                         for name, documents in collections.items())
+        self.indexer = FakeIndexer()
+        self.ingestion = IngestionStats(self)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.db[name]
+
+
+@pytest.fixture
+def fake_mongo():
+    return FakeMongo
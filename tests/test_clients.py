@@ -0,0 +1,47 @@
+from clients import NodePool
+
+
+def test_best_node_is_sticky():
+    pool = NodePool(['http://a', 'http://b'])
+    pool.observe('http://a', 0.10)
+    pool.observe('http://b', 0.12)
+    assert pool.best() == 'http://a'
+
+    # b is only a little faster now, which is not worth a switch
+    pool.observe('http://a', 0.12)
+    pool.observe('http://b', 0.10)
+    assert pool.ranked()[0] == 'http://b'
+    assert pool.best() == 'http://a'
+
+    # a failing node is replaced right away
+    pool.observe('http://a', 0.10, error=True)
+    assert pool.best() == 'http://b'
+
+
+def test_pinned_node_comes_first():
+    pool = NodePool(['http://a', 'http://b'], pinned='http://b')
+    pool.observe('http://b', 0.10, error=True)
+    assert pool.best() == 'http://b'
+
+
+def test_client_is_reused(monkeypatch):
+    monkeypatch.setattr(NodePool, 'probe', lambda self: None)
+    pool = NodePool(['http://a', 'http://b'])
+    client = pool.client()
+    assert client.url == 'http://a'
+
+    pool.observe('http://a', 0.10, error=True)
+    assert pool.client() is client
+    assert client.url == 'http://b'
+
+
+def test_configure_replaces_the_nodes(monkeypatch):
+    monkeypatch.setattr(NodePool, 'probe', lambda self: None)
+    pool = NodePool(['http://a', 'http://b'])
+    pool.observe('http://a', 0.10)
+    client = pool.client()
+
+    pool.configure(['http://localhost:8090'])
+    assert pool.best() == 'http://localhost:8090'
+    assert pool.client() is not client
+    assert pool.client().url == 'http://localhost:8090'
@@ -0,0 +1,377 @@
+import json
+import os
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import methods
+from conftest import FakeBulkWriteResult
+
+
+def comment(author, permlink, parent=None, depth=0):
+    parent_author, parent_permlink = parent.lstrip('@').split('/') if parent else ('', 'steem')
+    return {'identifier': '@%s/%s' % (author, permlink), 'author': author,
+            'permlink': permlink, 'parent_author': parent_author,
+            'parent_permlink': parent_permlink, 'depth': depth}
+
+
+# Comments
+# --------
+def test_upsert_comment_chains_resolves_parents_by_level(fake_mongo, monkeypatch):
+    thread = {x['identifier']: x for x in [
+        comment('alice', 'post'),
+        comment('bob', 're-post', parent='@alice/post', depth=1),
+        comment('carol', 're-re-post', parent='@bob/re-post', depth=2),
+        comment('dave', 're-post', parent='@alice/post', depth=1),
+    ]}
+    requests = []
+
+    def fetch_comments(identifiers):
+        requests.append(set(identifiers))
+        # the node fails on @dave/re-post, which is skipped
+        return [thread[x] for x in identifiers if x != '@dave/re-post']
+
+    monkeypatch.setattr(methods, 'fetch_comments', fetch_comments)
+    mongo = fake_mongo(Posts=[], Comments=[comment('bob', 're-post', parent='@alice/post', depth=1)])
+
+    methods.upsert_comment_chains(mongo, ['@carol/re-re-post', '@dave/re-post', '@bob/re-post'])
+
+    assert requests == [{'@carol/re-re-post', '@dave/re-post', '@bob/re-post'}, {'@alice/post'}]
+    assert [x['identifier'] for x in mongo.Posts.documents] == ['@alice/post']
+    assert sorted(x['identifier'] for x in mongo.Comments.documents) == \
+        ['@bob/re-post', '@carol/re-re-post']
+    assert all('updatedAt' in x for x in mongo.Comments.documents)
+
+
+# Bulk writes
+# -----------
+class RejectingCollection(object):
+    """ Rejects the first bulk write with the given write error codes. """
+    name = 'Accounts'
+
+    def __init__(self, codes):
+        self.codes = codes
+        self.requests = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.requests.append(requests)
+        if len(self.requests) == 1:
+            raise BulkWriteError({
+                'writeErrors': [{'index': i, 'code': code} for i, code in self.codes.items()],
+                'nUpserted': len(requests) - len(self.codes),
+            })
+        return FakeBulkWriteResult()
+
+
+def test_bulk_write_safe_blanks_invalid_json_metadata():
+    collection = RejectingCollection({1: 57})
+    documents = [{'name': 'alice', 'json_metadata': {}},
+                 {'name': 'bob', 'json_metadata': {'a.b': 1}}]
+
+    result = methods.bulk_write_safe(collection, documents, lambda x: x)
+
+    assert collection.requests[1] == [{'name': 'bob', 'json_metadata': {}}]
+    assert result['nUpserted'] == 1
+
+
+def test_bulk_write_safe_skips_duplicates():
+    collection = RejectingCollection({0: 11000})
+    methods.bulk_write_safe(collection, [{'name': 'alice'}], lambda x: x)
+    assert len(collection.requests) == 1
+
+
+def test_bulk_write_safe_raises_other_errors():
+    collection = RejectingCollection({0: 11000, 1: 8000})
+    with pytest.raises(BulkWriteError):
+        methods.bulk_write_safe(collection, [{'name': 'alice'}, {'name': 'bob'}], lambda x: x)
+    assert len(collection.requests) == 1
+
+
+# Account history
+# ---------------
+def history_event(index, account='alice'):
+    return {
+        '_id': 'op-%s' % index,
+        'index': index,
+        'account': account,
+        'type': 'vote',
+        'voter': account,
+        'timestamp': '2017-01-01T00:00:00',
+    }
+
+
+class FakeAccount(object):
+    """ An account with a history of `FakeAccount.size` ops. """
+    size = 10
+
+    def __init__(self, username, steemd_instance=None):
+        self.name = username
+
+    def history(self, start=0, batch_size=1000):
+        return (history_event(x, self.name) for x in range(start, self.size))
+
+    def history_reverse(self, batch_size=1000):
+        return (history_event(x, self.name) for x in reversed(range(self.size)))
+
+
+@pytest.fixture
+def fake_account(monkeypatch):
+    monkeypatch.setattr(methods, 'Account', FakeAccount)
+    monkeypatch.setattr(methods, 'get_steemd', lambda: None)
+
+
+def stored_indexes(mongo):
+    return sorted(x['index'] for x in mongo.AccountOperations.documents)
+
+
+def test_account_operations_index(fake_mongo):
+    mongo = fake_mongo(AccountOperations=[history_event(x) for x in (0, 3, 7)])
+    assert methods.account_operations_index(mongo, 'alice') == 7
+    assert methods.account_operations_index(mongo, 'bob') == 0
+
+
+def test_update_account_ops_fills_tail_and_gaps(fake_mongo, fake_account):
+    mongo = fake_mongo(AccountOperations=[history_event(x) for x in (0, 1, 4, 5)])
+    result = methods.update_account_ops(mongo, 'alice')
+    # index 5 is re-fetched as the start of the tail, but not re-inserted
+    assert result == {'fetched': 2 + 5, 'inserted': 2 + 4, 'skipped': 4}
+    assert stored_indexes(mongo) == list(range(FakeAccount.size))
+
+
+def test_update_account_ops_new_account(fake_mongo, fake_account):
+    mongo = fake_mongo(AccountOperations=[])
+    result = methods.update_account_ops(mongo, 'alice')
+    assert result['inserted'] == FakeAccount.size
+    assert stored_indexes(mongo) == list(range(FakeAccount.size))
+
+
+def test_update_account_ops_quick(fake_mongo, fake_account):
+    mongo = fake_mongo(AccountOperations=[history_event(x) for x in range(7)])
+    methods.update_account_ops_quick(mongo, 'alice')
+    assert stored_indexes(mongo) == list(range(FakeAccount.size))
+
+
+def test_derived_account_ops_are_not_synced_ones(fake_mongo):
+    derived = {'_id': 'derived', 'account': 'alice', 'type': 'vote', 'block_num': 1}
+    mongo = fake_mongo(AccountOperations=[derived] + [history_event(x) for x in (0, 1, 2)])
+    assert methods.account_operations_index(mongo, 'alice') == 2
+    assert methods.account_operations_gaps(mongo, 'alice', 2) == []
+    # a missing `index` is not a stored index 0
+    mongo = fake_mongo(AccountOperations=[derived, history_event(2)])
+    assert methods.account_operations_gaps(mongo, 'alice', 2) == [(0, 1)]
+
+
+# Derived AccountOperations
+# -------------------------
+def account_history():
+    """ `get_account_history('alice', -1, 1000)`, as an Operations entry per op. """
+    path = os.path.join(os.path.dirname(__file__), 'fixtures', 'account_history.json')
+    with open(path) as f:
+        for index, item in json.load(f):
+            op_type, op = item['op']
+            yield {**op, '_id': 'op-%s' % index, 'type': op_type, 'block_num': item['block']}
+
+
+def test_derive_account_operations_covers_account_history():
+    for op in account_history():
+        accounts = [x['account'] for x in methods.derive_account_operations(op)]
+        assert 'alice' in accounts, op['type']
+        assert len(accounts) == len(set(accounts))
+
+
+def test_impacted_accounts():
+    ops = list(account_history())
+    assert methods.impacted_accounts(ops[0]) == {'steem', 'alice'}  # account_create_with_delegation
+    assert methods.impacted_accounts(ops[3]) == {'alice', 'bob'}  # vote
+    assert methods.impacted_accounts(ops[4]) == {'alice', 'carol'}  # comment
+    assert methods.impacted_accounts(ops[6]) == {'alice'}  # custom_json
+    assert methods.impacted_accounts(ops[9]) == {'alice', 'gtg'}  # account_witness_vote
+    assert methods.impacted_accounts(ops[17]) == {'alice'}  # producer_reward
+
+
+# Account refresh
+# ---------------
+def raw_account(**fields):
+    """ A `get_accounts` result, with the fields that `export_account_light` reads. """
+    return {
+        'name': 'alice',
+        'json_metadata': '{"profile": {"name": "Alice"}}',
+        'reputation': '95832978796820',
+        'created': '2016-03-24T16:05:00',
+        'last_vote_time': '2017-06-30T09:12:03',
+        'balance': '10.000 STEEM',
+        'sbd_balance': '1.000 SBD',
+        'savings_balance': '0.000 STEEM',
+        'savings_sbd_balance': '0.000 SBD',
+        'vesting_shares': '2000000.000000 VESTS',
+        'reward_steem_balance': '0.000 STEEM',
+        'reward_sbd_balance': '0.000 SBD',
+        'reward_vesting_balance': '0.000000 VESTS',
+        **fields,
+    }
+
+
+def test_export_account_light():
+    account = methods.export_account_light(raw_account(), steem_per_mvests=500)
+    assert account['account'] == 'alice'
+    assert account['profile'] == {'name': 'Alice'}
+    assert account['sp'] == 1000
+    assert account['rep'] == 69.83
+    assert account['balances']['total'] == {'STEEM': 10, 'SBD': 1, 'VESTS': 2000000}
+
+
+def test_changed_fields_of_an_unchanged_account():
+    stored = methods.export_account_light(raw_account(), steem_per_mvests=500)
+    account = methods.export_account_light(raw_account(), steem_per_mvests=500)
+    assert methods.changed_fields(account, stored) == {}
+
+
+def test_changed_fields():
+    stored = methods.export_account_light(raw_account(), steem_per_mvests=500)
+    account = methods.export_account_light(
+        raw_account(balance='12.000 STEEM', last_vote_time='2017-07-01T00:00:00'),
+        steem_per_mvests=500)
+    assert sorted(methods.changed_fields(account, stored)) == \
+        ['balance', 'balances', 'last_vote_time']
+    # fields that were never stored are new
+    assert 'balance' in methods.changed_fields(account, {'name': 'alice'})
+
+
+class FakeSteem(object):
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.calls = []
+
+    def get_dynamic_global_properties(self):
+        return {'total_vesting_fund_steem': '500.000 STEEM',
+                'total_vesting_shares': '1000000.000000 VESTS'}
+
+    def get_accounts(self, names):
+        self.calls.append(names)
+        return [self.accounts[x] for x in names if x in self.accounts]
+
+
+def test_fetch_accounts_in_batches():
+    steem = FakeSteem({x: raw_account(name=x) for x in ['alice', 'bob', 'carol']})
+    accounts = methods.fetch_accounts(['alice', 'bob', 'carol', 'nobody'], batch_size=2, steem=steem)
+    assert steem.calls == [['alice', 'bob'], ['carol', 'nobody']]
+    assert sorted(accounts) == ['alice', 'bob', 'carol']
+    assert accounts['bob']['sp'] == 1000
+
+
+# parse_operations
+# ----------------
+def parsed(op):
+    result = methods.parse_operation(op)
+    return (
+        sorted(result['accounts']),
+        sorted(result['accounts_light']),
+        sorted(result['comments']),
+        {k: sorted(v) for k, v in result['account_extras'].items()},
+    )
+
+
+all_extras = sorted(methods.account_extras_loaders)
+
+parse_cases = [
+    ({'type': 'account_create', 'creator': 'alice', 'new_account_name': 'bob'},
+     (['bob'], ['alice'], [], {'bob': all_extras})),
+    ({'type': 'account_create_with_delegation', 'creator': 'alice', 'new_account_name': 'bob'},
+     (['bob'], ['alice'], [], {'bob': all_extras})),
+    ({'type': 'account_update', 'account': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'withdraw_vesting', 'account': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'claim_reward_balance', 'account': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'return_vesting_delegation', 'account': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'account_witness_vote', 'account': 'alice', 'witness': 'bob'},
+     ([], ['alice'], [], {})),
+    ({'type': 'account_witness_proxy', 'account': 'alice', 'proxy': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'author_reward', 'author': 'alice', 'permlink': 'post'},
+     ([], ['alice'], ['@alice/post'], {})),
+    ({'type': 'comment', 'author': 'alice', 'permlink': 'post'},
+     ([], ['alice'], ['@alice/post'], {})),
+    ({'type': 'vote', 'voter': 'bob', 'author': 'alice', 'permlink': 'post'},
+     ([], ['bob'], ['@alice/post'], {})),
+    ({'type': 'cancel_transfer_from_savings', 'from': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'change_recovery_account', 'account_to_recover': 'alice'},
+     ([], ['alice'], [], {})),
+    ({'type': 'comment_benefactor_reward', 'benefactor': 'alice'}, ([], ['alice'], [], {})),
+    # these never matched in the if/elif chain
+    ({'type': 'convert', 'owner': 'alice'},
+     ([], ['alice'], [], {'alice': ['conversion_requests']})),
+    ({'type': 'fill_convert_request', 'owner': 'alice'},
+     ([], ['alice'], [], {'alice': ['conversion_requests']})),
+    ({'type': 'interest', 'owner': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'limit_order_cancel', 'owner': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'limit_order_create', 'owner': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'shutdown_witness', 'owner': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'witness_update', 'owner': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'curation_reward', 'curator': 'alice'},
+     ([], ['alice'], [], {'alice': ['curation_stats']})),
+    ({'type': 'custom', 'required_auths': ['alice']}, ([], ['alice'], [], {})),
+    ({'type': 'custom_json', 'id': 'follow', 'required_posting_auths': ['alice'],
+      'json': ['follow', {'follower': 'alice', 'following': 'bob', 'what': ['blog']}]},
+     ([], ['alice'], [], {'alice': ['followers'], 'bob': ['followers']})),
+    ({'type': 'custom_json', 'id': 'follow', 'required_posting_auths': ['alice'],
+      'json': ['reblog', {'account': 'alice', 'author': 'bob', 'permlink': 'post'}]},
+     ([], ['alice'], [], {})),
+    ({'type': 'delegate_vesting_shares', 'delegator': 'alice', 'delegatee': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'delete_comment', 'author': 'alice', 'permlink': 'post'},
+     ([], ['alice'], [], {})),
+    ({'type': 'escrow_approve', 'from': 'alice', 'to': 'bob', 'agent': 'carol', 'who': 'bob'},
+     ([], ['alice', 'bob', 'carol'], [], {})),
+    ({'type': 'escrow_dispute', 'from': 'alice', 'to': 'bob', 'agent': 'carol', 'who': 'alice'},
+     ([], ['alice', 'bob', 'carol'], [], {})),
+    ({'type': 'escrow_release', 'from': 'alice', 'to': 'bob', 'agent': 'carol',
+      'who': 'carol', 'receiver': 'dave'},
+     ([], ['alice', 'bob', 'carol', 'dave'], [], {})),
+    ({'type': 'escrow_transfer', 'from': 'alice', 'to': 'bob', 'agent': 'carol'},
+     ([], ['alice', 'bob', 'carol'], [], {})),
+    ({'type': 'feed_publish', 'publisher': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'fill_order', 'open_owner': 'alice', 'current_owner': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'fill_vesting_withdraw', 'from_account': 'alice', 'to_account': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'pow2', 'work': [0, {'input': {'worker_account': 'alice'}}]},
+     ([], ['alice'], [], {})),
+    ({'type': 'recover_account', 'account_to_recover': 'alice'}, ([], ['alice'], [], {})),
+    ({'type': 'request_account_recovery', 'account_to_recover': 'alice'},
+     ([], ['alice'], [], {})),
+    ({'type': 'set_withdraw_vesting_route', 'from_account': 'alice', 'to_account': 'bob'},
+     ([], ['alice', 'bob'], [], {'alice': ['withdrawal_routes']})),
+    ({'type': 'transfer', 'from': 'alice', 'to': 'bob'}, ([], ['alice', 'bob'], [], {})),
+    ({'type': 'transfer_from_savings', 'from': 'alice', 'to': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'transfer_to_savings', 'from': 'alice', 'to': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'transfer_to_vesting', 'from': 'alice', 'to': 'bob'},
+     ([], ['alice', 'bob'], [], {})),
+    ({'type': 'producer_reward', 'producer': 'alice'}, ([], [], [], {})),
+]
+
+
+@pytest.mark.parametrize('op, expected', parse_cases, ids=[x[0]['type'] for x in parse_cases])
+def test_parse_operation(op, expected):
+    assert parsed(op) == expected
+
+
+def test_every_handled_op_type_is_covered():
+    assert set(methods.operation_handlers) <= {x[0]['type'] for x in parse_cases}
+
+
+def test_parse_operations_merges_a_batch():
+    ops = [
+        {'type': 'vote', 'voter': 'bob', 'author': 'alice', 'permlink': 'post'},
+        {'type': 'vote', 'voter': 'carol', 'author': 'alice', 'permlink': 'post'},
+        {'type': 'curation_reward', 'curator': 'bob'},
+        {'type': 'account_create', 'creator': 'alice', 'new_account_name': 'dave'},
+    ]
+    result = methods.parse_operations(ops)
+    assert sorted(result['accounts']) == ['dave']
+    assert sorted(result['accounts_light']) == ['alice', 'bob', 'carol']
+    assert result['comments'] == ['@alice/post']
+    assert {k: sorted(v) for k, v in result['account_extras'].items()} == {
+        'bob': ['curation_stats'],
+        'dave': all_extras,
+    }
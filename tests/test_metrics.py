@@ -0,0 +1,79 @@
+import pytest
+
+from metrics import Buckets, Registry
+
+
+def test_buckets_are_cumulative():
+    buckets = Buckets([0.1, 1])
+    for x in [0.05, 0.5, 0.5, 5]:
+        buckets.observe(x)
+    assert buckets.export() == {
+        'buckets': {'0.1': 1, '1': 3, '+Inf': 4},
+        'sum': 6.05,
+        'count': 4,
+    }
+
+
+def test_render_counters_and_gauges():
+    registry = Registry()
+    calls = registry.counter('rpc_calls_total', 'RPC calls', ['method', 'node'])
+    calls.inc(method='get_block', node='https://api.steemit.com')
+    calls.inc(2, method='get_block', node='https://api.steemit.com')
+    lag = registry.gauge('lag_blocks', 'Blocks behind', collect=lambda: {(): 3})
+
+    assert registry.render() == '\n'.join([
+        '# HELP lag_blocks Blocks behind',
+        '# TYPE lag_blocks gauge',
+        'lag_blocks 3',
+        '# HELP rpc_calls_total RPC calls',
+        '# TYPE rpc_calls_total counter',
+        'rpc_calls_total{method="get_block",node="https://api.steemit.com"} 3',
+    ]) + '\n'
+    assert lag.export() == {'_': 3}
+
+
+def test_render_histograms():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency', ['method'], buckets=[1])
+    latency.observe(0.5, method='get_block')
+    latency.observe(2.0, method='get_block')
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{method="get_block",le="1"} 1',
+        'latency_seconds_bucket{method="get_block",le="+Inf"} 2',
+        'latency_seconds_sum{method="get_block"} 2.5',
+        'latency_seconds_count{method="get_block"} 2',
+    ]
+
+
+def test_render_escapes_labels_and_skips_failed_collectors():
+    registry = Registry()
+    registry.counter('errors_total', 'Errors', ['error']).inc(error='say "hi"\n')
+
+    def collect():
+        raise ConnectionError('node is down')
+
+    registry.gauge('head_block', 'Head block', collect=collect)
+
+    lines = registry.render().splitlines()
+    assert 'errors_total{error="say \\"hi\\"\\n"} 1' in lines
+    assert '# head_block failed: node is down' in lines
+
+
+def test_registry_reuses_metrics_by_name():
+    registry = Registry()
+    assert registry.counter('x_total', 'X') is registry.counter('x_total', 'X')
+    with pytest.raises(AssertionError):
+        registry.gauge('x_total', 'X')
+
+
+def test_persist_is_mongo_safe(fake_mongo):
+    registry = Registry()
+    registry.counter('calls_total', 'Calls', ['node']).inc(node='https://api.steemit.com')
+    registry.histogram('latency_seconds', 'Latency', buckets=[0.5]).observe(0.1)
+    mongo = fake_mongo()
+
+    registry.persist(mongo, 'scrape_operations')
+    metrics = mongo.stats.find_one({})['metrics.scrape_operations']
+    assert metrics['calls_total'] == {'https://api#steemit#com': 1}
+    assert metrics['latency_seconds']['_']['buckets'] == {'0#5': 1, '+Inf': 1}
@@ -0,0 +1,192 @@
+import pytest
+from pymongo.errors import BulkWriteError
+
+from conftest import FakeCollection
+from mongostorage import (
+    BufferedWriter,
+    IngestionStats,
+    Indexer,
+    MongoStorage,
+    _flushable,
+    checkpoint_block,
+    index_name,
+    index_spec,
+)
+
+
+# Indexes
+# -------
+class FakeDB(dict):
+    def __init__(self, collection_class):
+        super().__init__()
+        self.collection_class = collection_class
+
+    def __missing__(self, key):
+        self[key] = self.collection_class()
+        return self[key]
+
+
+class FakeIndexedCollection(object):
+    def __init__(self):
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def index_information(self):
+        return dict(self.indexes)
+
+    def create_index(self, keys, **options):
+        self.indexes[index_name(keys)] = {'key': keys, **options}
+
+
+def indexed_storage():
+    storage = MongoStorage.__new__(MongoStorage)
+    storage.db = FakeDB(FakeIndexedCollection)
+    return storage
+
+
+def test_plan_indexes_skips_existing_and_deferred():
+    storage = indexed_storage()
+    storage.db['Accounts'].create_index([('name', 1)], unique=True)
+
+    plan = storage.plan_indexes()
+    assert len(plan) == len(index_spec) - 1
+    assert not any(x.collection == 'Accounts' for x in plan)
+    assert all(not x.deferrable for x in storage.plan_indexes(defer=True))
+
+    storage.ensure_indexes(defer=True)
+    assert all(x.deferrable for x in storage.plan_indexes())
+    storage.ensure_indexes()
+    assert storage.plan_indexes() == []
+
+
+# BufferedWriter
+# --------------
+def test_buffered_writer_is_due():
+    writer = BufferedWriter(FakeCollection('Operations'), batch_size=2, flush_interval=60)
+    assert not writer.is_due()
+    writer.add({'_id': 1})
+    assert not writer.is_due()
+    writer.add({'_id': 2})
+    assert writer.is_due()
+
+    writer = BufferedWriter(FakeCollection('Operations'), batch_size=2, flush_interval=0)
+    assert not writer.is_due()
+    writer.add({'_id': 1})
+    assert writer.is_due()
+
+
+def test_buffered_writer_skips_duplicates():
+    collection = FakeCollection('Operations', [{'_id': 1}])
+    writer = BufferedWriter(collection)
+    for x in [1, 2, 3]:
+        writer.add({'_id': x})
+
+    assert writer.flush() == 2
+    assert len(writer) == 0
+    assert sorted(x['_id'] for x in collection.documents) == [1, 2, 3]
+    assert writer.flush() == 0
+
+
+def test_buffered_writer_raises_other_errors():
+    class FailingCollection(FakeCollection):
+        def insert_many(self, documents, ordered=True):
+            raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 2}], 'nInserted': 0})
+
+    writer = BufferedWriter(FailingCollection('Operations'))
+    writer.add({'_id': 1})
+    with pytest.raises(BulkWriteError):
+        writer.flush()
+
+
+# IngestionStats
+# --------------
+def test_ingestion_stats_coalesce_counters(fake_mongo):
+    mongo = fake_mongo()
+    ingestion = IngestionStats(mongo, flush_interval=60)
+    writer = BufferedWriter(FakeCollection('Operations', [{'_id': 1}]), ingestion=ingestion)
+    for x in [1, 2, 3]:
+        writer.add({'_id': x})
+    writer.flush()
+    ingestion.record('Accounts', {'nUpserted': 1, 'nModified': 2})
+    ingestion.record('Accounts', {'nModified': 1})
+    assert not mongo.stats.documents
+
+    ingestion.flush()
+    stats = mongo.stats.find_one({})
+    assert stats['ingestion.Operations.inserted'] == 2
+    assert stats['ingestion.Accounts.upserted'] == 1
+    assert stats['ingestion.Accounts.modified'] == 3
+    assert 'ingestion.Accounts.inserted' not in stats
+
+    # counters are added to, not overwritten
+    ingestion.incr('Operations', 'inserted', 5)
+    ingestion.flush()
+    assert mongo.stats.find_one({})['ingestion.Operations.inserted'] == 7
+
+
+# Indexer
+# -------
+class FakeIndexerCollection(object):
+    """ A single `_indexer` document, with flat field names. """
+
+    def __init__(self):
+        self.document = {}
+
+    def update_one(self, query, update, upsert=False):
+        for field, value in update.get('$setOnInsert', {}).items():
+            self.document.setdefault(field, value)
+
+    def find_one(self):
+        return dict(self.document)
+
+    def find_one_and_update(self, query, update, return_document=None):
+        for field, value in update.get('$set', {}).items():
+            self.document[field] = value
+        for field, value in update.get('$max', {}).items():
+            if field not in self.document or value > self.document[field]:
+                self.document[field] = value
+        return dict(self.document)
+
+
+class FakeMongo(object):
+    def __init__(self):
+        self.db = FakeDB(FakeIndexerCollection)
+
+
+@pytest.fixture
+def mongo():
+    return FakeMongo()
+
+
+@pytest.fixture
+def indexer(mongo):
+    indexer = Indexer(mongo, flush_interval=60)
+    yield indexer
+    _flushable.discard(indexer)
+
+
+def test_checkpoints_never_regress(indexer, mongo):
+    indexer.set_checkpoint('comments', 100)
+    indexer.set_checkpoint('comments', 90)
+    assert indexer.get_checkpoint('comments') == 100
+    assert checkpoint_block.snapshot()[('comments',)] == 100
+
+    indexer.flush()
+    assert mongo.db['_indexer'].document['comments_checkpoint'] == 100
+
+
+def test_forced_checkpoints_reset(indexer, mongo):
+    indexer.set_checkpoint('accounts', 'alice')
+    indexer.set_checkpoint('accounts', -1, force=True)
+    assert indexer.get_checkpoint('accounts') == -1
+
+    indexer.flush()
+    assert mongo.db['_indexer'].document['accounts_checkpoint'] == -1
+
+
+def test_other_workers_checkpoints_are_reloaded(indexer, mongo):
+    assert indexer.get_checkpoint('operations') == 1
+    mongo.db['_indexer'].document['operations_checkpoint'] = 500
+    assert indexer.get_checkpoint('operations') == 1
+
+    indexer.flush_interval = 0
+    assert indexer.get_checkpoint('operations') == 500
@@ -0,0 +1,110 @@
+from pipeline import Batch, EventBus, Subscriber, account_operations
+
+
+def operation(block_num, type='vote'):
+    return {'_id': 'op-%s-%s' % (block_num, type), 'block_num': block_num,
+            'type': type, 'voter': 'alice', 'author': 'bob', 'permlink': 'x'}
+
+
+class Recorder(object):
+    """ A stage that records the processed operations, and catches up by `step` blocks. """
+
+    def __init__(self, mongo, name, step=None):
+        self.mongo = mongo
+        self.name = name
+        self.step = step
+        self.processed = []
+        self.catch_ups = 0
+
+    def process(self, mongo, operations):
+        self.processed += [x['block_num'] for x in operations]
+
+    def catch_up(self, mongo):
+        if not self.step:
+            return None
+        self.catch_ups += 1
+        index = mongo.indexer.get_checkpoint(self.name) + self.step
+        mongo.indexer.set_checkpoint(self.name, index)
+        return index
+
+    def subscriber(self, **kwargs):
+        return Subscriber(self.mongo, self.name, self.process, self.catch_up, **kwargs)
+
+
+def batch(first_block, last_block, types=('vote',)):
+    return Batch([operation(x, t) for x in range(first_block, last_block + 1)
+                  for t in types],
+                 first_block, last_block)
+
+
+def test_subscriber_processes_batches(fake_mongo):
+    mongo = fake_mongo()
+    mongo.indexer.set_checkpoint('comments', 9)
+    stage = Recorder(mongo, 'comments')
+
+    stage.subscriber().handle(batch(10, 12))
+    assert stage.processed == [10, 11, 12]
+    assert stage.catch_ups == 0
+    assert mongo.indexer.get_checkpoint('comments') == 12
+
+
+def test_subscriber_catches_up_before_a_batch(fake_mongo):
+    mongo = fake_mongo()
+    mongo.indexer.set_checkpoint('comments', 1)
+    stage = Recorder(mongo, 'comments', step=4)
+
+    stage.subscriber().handle(batch(10, 12))
+    # caught up to 5 and then 9, from Mongo
+    assert stage.catch_ups == 2
+    assert stage.processed == [10, 11, 12]
+    assert mongo.indexer.get_checkpoint('comments') == 12
+
+
+def test_subscriber_skips_processed_operations(fake_mongo):
+    mongo = fake_mongo()
+    mongo.indexer.set_checkpoint('comments', 1)
+    stage = Recorder(mongo, 'comments', step=10)
+
+    # the catch up overshoots into the batch
+    stage.subscriber().handle(batch(10, 15))
+    assert stage.processed == [12, 13, 14, 15]
+
+    # a batch that was processed already
+    stage.subscriber().handle(batch(14, 15))
+    assert stage.processed == [12, 13, 14, 15]
+
+
+def test_subscriber_filters_types(fake_mongo):
+    mongo = fake_mongo()
+    mongo.indexer.set_checkpoint('comments', 9)
+    stage = Recorder(mongo, 'comments')
+
+    stage.subscriber(types={'comment'}).handle(batch(10, 11, types=('vote', 'comment')))
+    assert stage.processed == [10, 11]
+    assert mongo.indexer.get_checkpoint('comments') == 11
+
+
+def test_event_bus_feeds_every_subscriber(fake_mongo):
+    mongo = fake_mongo()
+    mongo.indexer.set_checkpoint('comments', 9)
+    mongo.indexer.set_checkpoint('post_processing', 9)
+    stages = [Recorder(mongo, 'comments'), Recorder(mongo, 'post_processing')]
+
+    bus = EventBus()
+    for stage in stages:
+        bus.subscribe(stage.subscriber(queue_size=1))
+    for x in (10, 12, 14):
+        bus.publish(*batch(x, x + 1))
+    bus.close()
+
+    assert [x.processed for x in stages] == [list(range(10, 16))] * 2
+
+
+def test_account_operations_leave_out_bodies(fake_mongo):
+    mongo = fake_mongo(AccountOperations=[])
+    op = {**operation(10, 'comment'), 'author': 'alice', 'parent_author': 'bob',
+          'body': 'text'}
+
+    assert account_operations(mongo, [op]) == 2
+    assert all('body' not in x for x in mongo.AccountOperations.documents)
+    assert op['body'] == 'text'
@@ -0,0 +1,85 @@
+import pytest
+from aiohttp import web
+
+import rpc
+from clients import NodePool
+
+
+def post(author, permlink):
+    return {'author': author, 'permlink': permlink, 'depth': 0,
+            'parent_permlink': 'steem', 'json_metadata': '{"tags": ["test"]}'}
+
+
+@pytest.fixture
+def client():
+    client = rpc.AsyncSteemd(retries=0)
+    yield client
+    client.close()
+
+
+def serve(client, handler):
+    """ Serve `handler` on the event loop of `client`, returns the node url. """
+    app = web.Application()
+    app.router.add_post('/', handler)
+    runner = web.AppRunner(app)
+    client.run(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    client.run(site.start())
+    return 'http://127.0.0.1:%d/' % site._server.sockets[0].getsockname()[1]
+
+
+def test_get_comments_skips_failed_items(client):
+    async def steemd(request):
+        response = []
+        for call in await request.json():
+            _, method, (author, permlink) = call['params']
+            if author == 'bob':
+                response.append({'jsonrpc': '2.0', 'id': call['id'],
+                                 'error': {'code': -32000, 'message': 'boom'}})
+            elif method == 'get_content':
+                response.append({'jsonrpc': '2.0', 'id': call['id'],
+                                 'result': post(author, permlink)})
+            else:
+                response.append({'jsonrpc': '2.0', 'id': call['id'], 'result': ['carol']})
+        return web.json_response(response)
+
+    client.url = serve(client, steemd)
+    comments = client.run(client.get_comments(['@alice/a', '@bob/b', '@dave/d']))
+
+    assert [x['identifier'] for x in comments] == ['@alice/a', '@dave/d']
+    assert comments[0]['reblogged_by'] == ['carol']
+    assert comments[0]['tags'] == ['steem', 'test']
+
+
+def test_call_batch_raises_on_failed_batch(client):
+    async def steemd(request):
+        return web.json_response({'jsonrpc': '2.0', 'id': None,
+                                  'error': {'code': -32600, 'message': 'bad batch'}})
+
+    client.url = serve(client, steemd)
+    with pytest.raises(rpc.RPCError):
+        client.run(client.call_batch('get_content', [['alice', 'a']]))
+
+
+def test_requests_fail_over_to_healthy_nodes(monkeypatch):
+    async def down(request):
+        return web.Response(status=503)
+
+    async def up(request):
+        return web.json_response([
+            {'jsonrpc': '2.0', 'id': x['id'], 'result': {'author': x['params'][2][0]}}
+            for x in await request.json()
+        ])
+
+    client = rpc.AsyncSteemd(retries=2)
+    bad, good = serve(client, down), serve(client, up)
+    pool = NodePool([bad, good])
+    monkeypatch.setattr(rpc, 'node_pool', pool)
+
+    try:
+        assert client.run(client.call_batch('get_content', [['alice', 'x']])) == [{'author': 'alice'}]
+    finally:
+        client.close()
+    assert pool.errors[bad] == 1
+    assert pool.best() == good
+    assert pool.latency[good].count == 1
@@ -0,0 +1,150 @@
+import pytest
+
+import scraper
+
+
+def operation(block_num, n=0, account='alice'):
+    return {'_id': 'op-%s-%s' % (block_num, n), 'block_num': block_num,
+            'type': 'vote', 'voter': account, 'author': 'bob', 'permlink': 'x'}
+
+
+class FakeBlockchain(object):
+    """ A chain with the given operations, for `Blockchain.history`. """
+    operations = []
+
+    class steem(object):
+        hostname = 'localhost'
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def history(self, start_block=1, end_block=None):
+        for x in self.operations:
+            if end_block and x['block_num'] > end_block:
+                # like steem-python, which makes this a RuntimeError since Python 3.7
+                raise StopIteration('end_block reached')
+            if x['block_num'] >= start_block:
+                yield x
+
+
+# scrape_operations
+# -----------------
+def test_scrape_operations_checkpoints_flushed_blocks(fake_mongo, monkeypatch):
+    FakeBlockchain.operations = [operation(x, n) for x, n in
+                                 [(5, 0), (5, 1), (6, 0), (7, 0), (7, 1), (8, 0)]]
+    monkeypatch.setattr(scraper, 'Blockchain', FakeBlockchain)
+    monkeypatch.setattr(scraper, 'get_steemd', lambda: None)
+    mongo = fake_mongo(Operations=[])
+    indexer = mongo.indexer
+    indexer.set_checkpoint('operations', 4)
+
+    scraper.scrape_operations(mongo, batch_size=2, flush_interval=60)
+
+    # the end of a finite history is written, but not checkpointed
+    assert indexer.get_checkpoint('operations') == 7
+    assert sorted(x['block_num'] for x in mongo.Operations.documents) == [5, 5, 6, 7, 7, 8]
+
+
+# backfill_operations
+# -------------------
+def test_backfill_operations_range(fake_mongo, monkeypatch):
+    FakeBlockchain.operations = [operation(x) for x in range(1, 30)]
+    monkeypatch.setattr(scraper, 'Blockchain', FakeBlockchain)
+    monkeypatch.setattr(scraper, 'get_steemd', lambda: None)
+    mongo = fake_mongo(Operations=[operation(10)])
+    indexer = mongo.indexer
+    monkeypatch.setattr(scraper, 'MongoStorage', lambda **kwargs: mongo)
+
+    assert scraper.backfill_operations_range((10, 20), {}) == (10, 20)
+    assert indexer.get_range_checkpoint('operations', 10) == 19
+    assert sorted(x['block_num'] for x in mongo.Operations.documents) == list(range(10, 20))
+
+
+# scrape_all_users_sharded
+# ------------------------
+def test_username_shards_cover_all_letters():
+    shards = [scraper.username_shard(x, 4) for x in range(4)]
+    assert shards[0][0] == 'a' and shards[-1][1] is None
+    # every shard starts where the previous one ends
+    assert [x[1] for x in shards[:-1]] == [x[0] for x in shards[1:]]
+
+
+def test_username_progress():
+    lower, upper = scraper.username_shard(0, 4)
+    assert scraper.username_progress(lower, lower, upper) == 0
+    assert 0 < scraper.username_progress('b', lower, upper) < \
+        scraper.username_progress('d', lower, upper) < 1
+    assert scraper.username_progress('zzz', lower, upper) == 1
+
+
+# scrape_account_operations
+# -------------------------
+def test_scrape_account_operations_stops_at_operations_checkpoint(fake_mongo, monkeypatch):
+    monkeypatch.setattr(scraper, 'derived_account_ops', True)
+    mongo = fake_mongo(Operations=[operation(x) for x in range(1, 300)], AccountOperations=[])
+    indexer = mongo.indexer
+    indexer.set_checkpoint('account_operations', 100)
+    indexer.set_checkpoint('operations', 150)
+
+    assert scraper.scrape_account_operations(mongo, batch_size=100) == 150
+    assert max(x['block_num'] for x in mongo.AccountOperations.documents) == 150
+    # later blocks may still be backfilled, so there is no skipping ahead
+    assert scraper.scrape_account_operations(mongo, batch_size=100) is None
+    assert indexer.get_checkpoint('account_operations') == 150
+
+
+def test_scrape_account_operations_requires_derived_mode(fake_mongo, monkeypatch):
+    monkeypatch.setattr(scraper, 'derived_account_ops', False)
+    with pytest.raises(RuntimeError):
+        scraper.scrape_account_operations(fake_mongo(Operations=[]))
+
+
+# next_operations_window
+# ----------------------
+def test_next_operations_window_jumps_gaps(fake_mongo):
+    mongo = fake_mongo(Operations=[operation(x) for x in (5, 50, 51, 80)])
+    mongo.indexer.set_checkpoint('operations', 1000)
+    window = scraper.next_operations_window(mongo, {}, 10, size=31)
+    assert [x['block_num'] for x in window] == [50, 51, 80]
+
+
+def test_next_operations_window_stops_at_operations_checkpoint(fake_mongo):
+    # a backfill range past the checkpoint has already been written
+    mongo = fake_mongo(Operations=[operation(x) for x in (10, 11, 500, 501)])
+    mongo.indexer.set_checkpoint('operations', 11)
+    window = scraper.next_operations_window(mongo, {}, 9, size=100)
+    assert [x['block_num'] for x in window] == [10, 11]
+    assert scraper.next_operations_window(mongo, {}, 11, size=100) is None
+
+
+# Blockchain
+# ----------
+def block(block_num, fork=''):
+    return {'block_num': block_num,
+            'block_id': '%08x%s' % (block_num, fork),
+            'previous': '%08x' % (block_num - 1)}
+
+
+def test_insert_blocks_verifies_the_chain(fake_mongo):
+    mongo = fake_mongo(Blockchain=[block(9)])
+    verifier = scraper.ChainVerifier(mongo)
+
+    scraper.insert_blocks(mongo, [block(10), block(11)], verifier=verifier, batch_size=1)
+    assert [x['block_num'] for x in mongo.Blockchain.documents] == [9, 10, 11]
+
+    # block 13 builds on a block that was never seen
+    with pytest.raises(AssertionError):
+        scraper.insert_blocks(mongo, [block(13)], verifier=verifier)
+
+
+def test_chain_verifier_only_queries_on_a_miss(fake_mongo):
+    mongo = fake_mongo(Blockchain=[])
+    verifier = scraper.ChainVerifier(mongo, maxsize=2)
+    verifier.recent['%08x' % 1] = 1
+    for x in range(2, 5):
+        verifier.verify(block(x))
+    assert list(verifier.recent.values()) == [3, 4]
+
+    # evicted and not in the database
+    with pytest.raises(AssertionError):
+        verifier.verify(block(3, fork='ff'))
@@ -0,0 +1,147 @@
+from datetime import datetime
+
+import pytest
+from funcy import compose
+from steemdata.utils import json_expand, remove_body, typify
+
+from benchmark import sample_operations
+
+from utils import (
+    BlockWindow,
+    HeadBlockTracker,
+    RefreshCache,
+    get_pool,
+    normalize_operation,
+    prefetch,
+    stop_at_end,
+    strip_dot_from_keys,
+    thread_multi,
+)
+
+
+# stop_at_end
+# -----------
+def test_stop_at_end():
+    def history():
+        yield 1
+        yield 2
+        raise StopIteration('end_block reached')
+
+    assert list(stop_at_end(history())) == [1, 2]
+
+
+def test_stop_at_end_raises_other_errors():
+    def history():
+        yield 1
+        raise RuntimeError('node is down')
+
+    with pytest.raises(RuntimeError):
+        list(stop_at_end(history()))
+
+
+# Operations
+# ----------
+def test_normalize_operation_matches_composed_pipeline():
+    composed = compose(strip_dot_from_keys, remove_body, json_expand, typify)
+    for op in sample_operations:
+        assert normalize_operation(op, remove_body=True) == composed(op)
+
+
+def test_normalize_operation():
+    op = normalize_operation({
+        'type': 'custom_json',
+        'timestamp': '2018-02-18T12:00:09',
+        'amount': '1.000 STEEM',
+        'json': '{"items":[{"file.name":"a.png"}],"fee":"1.000 SBD"}',
+    })
+    assert op['timestamp'] == datetime(2018, 2, 18, 12, 0, 9)
+    assert op['amount'] == {'amount': 1.0, 'asset': 'STEEM'}
+    # expanded json is not typified, but has no dots in its keys either
+    assert op['json'] == {'items': [{'file#name': 'a.png'}], 'fee': '1.000 SBD'}
+
+
+def test_strip_dot_from_keys_in_lists():
+    assert strip_dot_from_keys({'a.b': [{'c.d': 1}, 2]}, replace_char='_') == \
+        {'a_b': [{'c_d': 1}, 2]}
+
+
+# prefetch
+# --------
+def test_prefetch_keeps_order():
+    assert list(prefetch(lambda x: x * 2, range(20), max_workers=4, window=3)) == \
+        [x * 2 for x in range(20)]
+
+
+# Worker pools
+# ------------
+def test_get_pool_is_keyed_by_size():
+    assert get_pool('test', max_workers=2) is get_pool('test', max_workers=2)
+    assert get_pool('test', max_workers=4).max_workers == 4
+
+
+def test_thread_multi():
+    results = thread_multi(
+        fn=lambda x, y: x + y,
+        fn_args=[None, 1],
+        dep_args=range(10),
+        max_workers=3,
+        pool='test',
+    )
+    assert sorted(results) == list(range(1, 11))
+
+
+# Refresh Coalescing
+# ------------------
+def test_refresh_cache_coalesces_with_a_trailing_refresh():
+    cache = RefreshCache(ttl=60)
+    assert cache.refresh(['a', 'b']) == {'a', 'b'}
+    assert cache.refresh(['a', 'a']) == set()
+    assert cache.due() == set()
+
+    # the window has passed for 'a'
+    cache._refreshed['a'] -= 60
+    assert cache.refresh([]) == {'a'}
+    assert cache.stats()['pending'] == 0
+
+
+# Adaptive Batching
+# -----------------
+def test_block_window_targets_ops_and_latency():
+    window = BlockWindow(size=100, target_ops=1000, target_latency=10)
+    # 400 ops in a second, room to grow, but at most twice as large
+    assert window.update(400, 1) == 200
+    assert window.update(1600, 1) == 125
+    # a slow batch shrinks the window, even with few ops
+    assert window.update(10, 20) == 62
+
+
+def test_block_window_is_bounded():
+    window = BlockWindow(size=4, min_size=2, max_size=6)
+    assert window.update(0, 0) == 6
+    for _ in range(5):
+        window.update(10 ** 6, 1)
+    assert window.size == 2
+
+
+# Head Block
+# ----------
+class FakeSteem(object):
+    calls = 0
+
+    def get_dynamic_global_properties(self):
+        self.calls += 1
+        return {'head_block_number': 100 + self.calls,
+                'last_irreversible_block_num': 80 + self.calls}
+
+
+def test_head_block_tracker_caches_the_head():
+    steem = FakeSteem()
+    tracker = HeadBlockTracker(ttl=60, steem=steem)
+    assert tracker.head_block_number == 101
+    assert tracker.last_irreversible_block_num == 81
+    assert tracker.lag(90) == 11
+    assert tracker.lag(200) == 0
+    assert steem.calls == 1
+
+    tracker.ttl = 0
+    assert tracker.head_block_number == 102